@@ -1,15 +1,32 @@
 from __future__ import annotations
 
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+import csv
+import glob
+import heapq
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
 import json
 import logging
 import os
+import queue
 import re
+import string
+import threading
 import time
 from typing import TYPE_CHECKING
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 from FunPayAPI.updater.events import NewOrderEvent, NewMessageEvent
 from telebot.types import InlineKeyboardMarkup as K, InlineKeyboardButton as B
@@ -26,8 +43,17 @@ UUID = "a7f3c8e2-9d4b-4f1a-8e5c-2b9d7f6a3c1e"
 SETTINGS_PAGE = False
 
 API_BASE_URL = "https://api.ns.gifts/api/v1"
+LOTS_PAGE_SIZE = 8
+REGIONS = ("ru", "ua", "kz")
 
+CONFIG_DIR = "storage/steam_gifts"
 CONFIG_PATH = f"{CONFIG_DIR}/config.json"
+JOURNAL_PATH = f"{CONFIG_DIR}/orders.jsonl"
+PENDING_PATH = f"{CONFIG_DIR}/pending.jsonl"
+STATS_PATH = f"{CONFIG_DIR}/stats.json"
+TOKEN_PATH = f"{CONFIG_DIR}/token.json"
+LEDGER_PATH = f"{CONFIG_DIR}/dispatch.jsonl"
+METRICS_PATH = f"{CONFIG_DIR}/metrics.prom"
 
 DEFAULT_CONFIG = {
     "api_login": "",
@@ -39,15 +65,667 @@ DEFAULT_CONFIG = {
         "invalid_link": "❌ Неверная ссылка на Steam профиль.\n\nПравильный формат:\n• steamcommunity.com/id/ВАШ_ID\n• steamcommunity.com/profiles/76561198XXXXXXXXX",
         "link_confirmation": "Подтвердите ваш Steam профиль:\n{link}\n\nОтправьте + для подтверждения или - для отмены",
         "purchase_success": "✅ Гифт \"{game_name}\" успешно отправлен!\n\n🎮 Проверьте подарки в Steam\n\nОставьте отзыв 😊",
+        "purchase_partial": "⚠️ Отправлено {sent} из {quantity} гифтов \"{game_name}\".\n\nОшибка: {error}\n\nОбратитесь к продавцу",
         "purchase_error": "❌ Ошибка отправки: {error}\n\nОбратитесь к продавцу",
         "insufficient_balance": "❌ Недостаточно средств на балансе.\n\nОбратитесь к продавцу",
+        "provider_unavailable": "⏳ Сервис отправки гифтов временно недоступен.\n\nВаш заказ сохранён в очереди, гифт будет отправлен автоматически, как только сервис восстановится",
+        "reminder_link": "⏰ Ваш заказ \"{game_name}\" ждёт ссылку на Steam профиль.\n\nОтправьте ссылку вида https://steamcommunity.com/id/ВАШ_ID",
+        "reminder_confirm": "⏰ Подтвердите Steam профиль для заказа \"{game_name}\":\n{link}\n\nОтправьте + для подтверждения или - для отмены",
+        "gift_status": "ℹ️ Гифт \"{game_name}\": {status}",
+        "gift_failed": "❌ Гифт \"{game_name}\" не доставлен: {status}\n\nОбратитесь к продавцу",
+        "order_expired": "⌛ Заказ \"{game_name}\" закрыт: ответа не было слишком долго.\n\nЕсли вы всё ещё хотите получить гифт, напишите продавцу",
     },
-    "order_history": [],
+    "language": "ru",
+    "templates_i18n": {},
+    "config_flush_delay": 1.0,
+    "token_refresh_margin": 300,
+    "token_cache": True,
+    "balance_ttl": 300,
+    "steam_api_key": "",
+    "vanity_cache_ttl": 86400,
+    "low_balance_threshold": 0,
+    "dispatch_workers": 4,
+    "batch_parallelism": 4,
+    "outbox": {
+        "rate": 2,
+        "burst": 3,
+        "retries": 3,
+        "backoff": 1.0,
+        "max_length": 2000,
+    },
+    "order_fetch": {
+        "workers": 2,
+        "retries": 3,
+        "backoff": 1.0,
+        "cache_ttl": 3600,
+    },
+    "ledger_retention_days": 30,
+    "status_tracking": {
+        "enabled": False,
+        "endpoint": "steam_gift/order_status",
+        "batch_size": 50,
+        "tick": 15,
+        "initial_interval": 60,
+        "max_interval": 3600,
+        "max_age": 7 * 86400,
+    },
+    "order_sweep": {
+        "interval": 60,
+        "remind_after": 1800,
+        "expire_after": 86400,
+        "refund_expired": False,
+    },
+    "metrics_file": False,
+    "metrics_interval": 15,
+    "metrics_port": 0,
+    "journal": {
+        "fsync": "interval",
+        "fsync_interval": 1.0,
+        "max_bytes": 5 * 1024 * 1024,
+        "backups": 0,
+    },
+    "circuit_breaker": {
+        "failures": 5,
+        "reset_timeout": 30,
+        "drain_batch": 5,
+        "drain_interval": 2,
+    },
+    "http": {
+        "base_url": API_BASE_URL,
+        "pool_size": 10,
+        "retries": 2,
+        "backoff": 0.5,
+        "rate_limit": {
+            "rate": 5,
+            "burst": 5,
+            "max_wait": 120,
+        },
+        "timeouts": {
+            "get_token": 10,
+            "check_balance": 10,
+            "steam_gift/create_order": 30,
+        },
+    },
+}
+
+TEMPLATE_FIELDS = {
+    "start_message": set(),
+    "invalid_link": set(),
+    "link_confirmation": {"link"},
+    "purchase_success": {"game_name"},
+    "purchase_partial": {"sent", "quantity", "game_name", "error"},
+    "purchase_error": {"error"},
+    "insufficient_balance": set(),
+    "provider_unavailable": set(),
+    "reminder_link": {"game_name"},
+    "reminder_confirm": {"game_name", "link"},
+    "order_expired": {"game_name"},
+    "gift_status": {"game_name", "status"},
+    "gift_failed": {"game_name", "status"},
 }
 
 logger = logging.getLogger("FPC.steamgifts")
 
 
+class Histogram:
+    """Гистограмма длительностей с фиксированными бакетами (секунды)"""
+
+    # Субмиллисекундные бакеты нужны для обработчиков событий, которые укладываются в десятые доли ms
+    BOUNDS = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10, 30, 60, 300, 900, 3600,
+    )
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        # Линейная интерполяция внутри бакета, последний бакет ограничен максимумом
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.BOUNDS[index - 1] if index else 0.0
+                upper = self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """Счётчики, гистограммы и показатели очередей для панели и Prometheus"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: Counter = Counter()
+        self.histograms: dict[tuple, Histogram] = {}
+        self.gauges: dict[str, object] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        # Значения меток приводятся к строкам: ключи должны сортироваться при экспорте
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name: str, func) -> None:
+        self.gauges[name] = func
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def counter_values(self, name: str) -> list[tuple[dict, float]]:
+        with self._lock:
+            return [(dict(labels), value) for (key, labels), value in self.counters.items() if key == name]
+
+    def histogram_values(self, name: str) -> list[tuple[dict, Histogram]]:
+        with self._lock:
+            return [(dict(labels), hist) for (key, labels), hist in self.histograms.items() if key == name]
+
+    def gauge_values(self) -> dict[str, float]:
+        values = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                values[name] = float(func())
+            except Exception:
+                continue
+        return values
+
+    def render_prometheus(self) -> str:
+        def labels_text(labels, extra: str = "") -> str:
+            parts = [f'{key}="{value}"' for key, value in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in histograms]
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{labels_text(labels)} {value:g}")
+
+        for (name, labels), counts, count, total in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket in zip((*Histogram.BOUNDS, "+Inf"), counts):
+                cumulative += bucket
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{labels_text(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{labels_text(labels)} {total:.6f}")
+            lines.append(f"{name}_count{labels_text(labels)} {count}")
+
+        for name, value in sorted(self.gauge_values().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debug("[SteamGifts] metrics: " + format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="SteamGifts-metrics", daemon=True).start()
+        return server
+
+
+metrics = Metrics()
+
+
+class ScheduledJob:
+    __slots__ = ("when", "func", "args", "interval", "cancelled")
+
+    def __init__(self, when: float, func, args: tuple, interval: float = 0.0):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    """Единый планировщик отложенных и периодических задач: куча по времени запуска и пул исполнителей"""
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._heap: list[tuple[float, int, ScheduledJob]] = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor | None = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def call_later(self, delay: float, func, *args) -> ScheduledJob:
+        return self._push(ScheduledJob(time.monotonic() + max(0.0, delay), func, args))
+
+    def call_soon(self, func, *args) -> ScheduledJob:
+        return self.call_later(0, func, *args)
+
+    def call_every(self, interval: float, func, *args, delay: float | None = None) -> ScheduledJob:
+        first = interval if delay is None else delay
+        return self._push(ScheduledJob(time.monotonic() + first, func, args, interval=interval))
+
+    def stop(self, timeout: float = 5) -> None:
+        with self._cond:
+            self._stopping = True
+            self._heap.clear()
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _push(self, job: ScheduledJob) -> ScheduledJob:
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="SteamGifts-job")
+                self._thread = threading.Thread(target=self._loop, name="SteamGifts-scheduler", daemon=True)
+                self._thread.start()
+            self._seq += 1
+            heapq.heappush(self._heap, (job.when, self._seq, job))
+            if self._heap[0][2] is job:
+                self._cond.notify()
+        return job
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        job = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                pool = self._pool
+            if not job.cancelled:
+                try:
+                    pool.submit(self._run, job)
+                except RuntimeError:
+                    return
+
+    def _run(self, job: ScheduledJob) -> None:
+        try:
+            job.func(*job.args)
+        except Exception as exc:
+            logger.error("[SteamGifts] Scheduled task %s failed: %s", getattr(job.func, "__name__", job.func), exc)
+        finally:
+            # Периодическая задача планируется заново после завершения, запуски не накладываются
+            if job.interval and not job.cancelled and not self._stopping:
+                job.when = time.monotonic() + job.interval
+                self._push(job)
+
+
+scheduler = Scheduler()
+
+
+def error_cause(error: str) -> str:
+    error = error.lower()
+    if "balance" in error or "insufficient" in error:
+        return "balance"
+    if "timed out" in error or "timeout" in error:
+        return "timeout"
+    if "connection" in error:
+        return "connection"
+    if "401" in error or "token" in error:
+        return "auth"
+    if "server error" in error or "client error" in error:
+        return "http"
+    return "api"
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket перед NS.Gifts API с адаптивным замедлением по 429/5xx"""
+
+    MIN_FACTOR = 0.1
+
+    def __init__(self, rate: float, burst: int = 1, max_wait: float = 120):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.max_wait = max_wait
+        self.factor = 1.0
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config: dict) -> RateLimiter | None:
+        if not config or not config.get("rate"):
+            return None
+        return cls(config["rate"], config.get("burst", 1), config.get("max_wait", 120))
+
+    @property
+    def current_rate(self) -> float:
+        return self.rate * self.factor
+
+    def acquire(self) -> float:
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.current_rate)
+                    self.updated = now
+                    if now < self.paused_until:
+                        self._cond.wait(self.paused_until - now)
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - start
+                    else:
+                        self._cond.wait((1 - self.tokens) / self.current_rate)
+            finally:
+                self.waiting -= 1
+
+    def penalize(self, retry_after: float | None = None) -> None:
+        # Мультипликативное замедление, пауза по Retry-After или по новому темпу
+        with self._cond:
+            self.factor = max(self.MIN_FACTOR, self.factor / 2)
+            pause = retry_after if retry_after is not None else 1 / self.current_rate
+            self.paused_until = max(self.paused_until, time.monotonic() + min(pause, self.max_wait))
+            self.tokens = 0.0
+
+    def reward(self) -> None:
+        if self.factor < 1.0:
+            with self._cond:
+                self.factor = min(1.0, self.factor + 0.05)
+
+
+class ProviderUnavailable(Exception):
+    """NS.Gifts недоступен, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Размыкает цепь после серии отказов провайдера и пропускает пробный запрос после паузы"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    # Общее состояние — худшее из состояний эндпоинтов
+    SEVERITY = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30, on_change=None):
+        self.failure_threshold = max(1, int(failures))
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.state = self.CLOSED
+        # Отказы считаются по эндпоинтам: успешные запросы баланса или токена не сбрасывают
+        # счётчик create_order. Здесь только эндпоинты с отказами, закрытые удаляются.
+        self._circuits: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> CircuitBreaker:
+        config = config or {}
+        return cls(config.get("failures", 5), config.get("reset_timeout", 30))
+
+    @property
+    def failures(self) -> int:
+        return max((circuit["failures"] for circuit in self._circuits.values()), default=0)
+
+    @property
+    def available(self) -> bool:
+        now = time.monotonic()
+        return all(
+            circuit["state"] != self.OPEN or now - circuit["opened_at"] >= self.reset_timeout
+            for circuit in list(self._circuits.values())
+        )
+
+    def before_call(self, endpoint: str = "") -> None:
+        with self._lock:
+            circuit = self._circuits.get(endpoint)
+            if circuit is None or circuit["state"] == self.CLOSED:
+                return
+            if circuit["state"] == self.OPEN and time.monotonic() - circuit["opened_at"] >= self.reset_timeout:
+                circuit["state"] = self.HALF_OPEN
+                self._update_state()
+            if circuit["state"] == self.HALF_OPEN and not circuit["probing"]:
+                circuit["probing"] = True
+                return
+        raise ProviderUnavailable("NS.Gifts временно недоступен")
+
+    def record_success(self, endpoint: str = "") -> None:
+        with self._lock:
+            if self._circuits.pop(endpoint, None) is not None:
+                self._update_state()
+
+    def release(self, endpoint: str = "") -> None:
+        with self._lock:
+            circuit = self._circuits.get(endpoint)
+            if circuit is not None:
+                circuit["probing"] = False
+
+    def record_failure(self, endpoint: str = "") -> None:
+        with self._lock:
+            circuit = self._circuits.setdefault(
+                endpoint, {"state": self.CLOSED, "failures": 0, "opened_at": 0.0, "probing": False}
+            )
+            circuit["failures"] += 1
+            circuit["probing"] = False
+            if circuit["state"] == self.HALF_OPEN or (
+                circuit["state"] == self.CLOSED and circuit["failures"] >= self.failure_threshold
+            ):
+                circuit["opened_at"] = time.monotonic()
+                circuit["state"] = self.OPEN
+                logger.warning("[SteamGifts] Circuit breaker opened for %s", endpoint or "API")
+            self._update_state()
+
+    def _update_state(self) -> None:
+        state = max(
+            (circuit["state"] for circuit in self._circuits.values()),
+            key=self.SEVERITY.__getitem__,
+            default=self.CLOSED,
+        )
+        if state != self.state:
+            self._set_state(state)
+
+    def _set_state(self, state: str) -> None:
+        previous, self.state = self.state, state
+        logger.warning("[SteamGifts] Circuit breaker: %s -> %s", previous, state)
+        if self.on_change:
+            scheduler.call_soon(self.on_change, previous, state)
+
+
+class HTTPTransport:
+    """Общий пул keep-alive соединений к NS.Gifts API"""
+
+    def __init__(
+        self,
+        base_url: str = API_BASE_URL,
+        pool_size: int = 10,
+        retries: int = 2,
+        backoff: float = 0.5,
+        timeouts: dict[str, float] | None = None,
+        default_timeout: float = 10,
+        limiter: RateLimiter | None = None,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+    @classmethod
+    def from_config(cls, config: dict) -> HTTPTransport:
+        http = config.get("http", {})
+        return cls(
+            base_url=http.get("base_url") or API_BASE_URL,
+            pool_size=http.get("pool_size", 10),
+            retries=http.get("retries", 2),
+            backoff=http.get("backoff", 0.5),
+            timeouts=http.get("timeouts"),
+            limiter=RateLimiter.from_config(http.get("rate_limit")),
+            breaker=CircuitBreaker.from_config(config.get("circuit_breaker")),
+        )
+
+    def request(self, method: str, endpoint: str, *, idempotent: bool = True, **kwargs) -> requests.Response:
+        if self.breaker is None:
+            return self._request(method, endpoint, idempotent=idempotent, **kwargs)
+
+        self.breaker.before_call(endpoint)
+        try:
+            response = self._request(method, endpoint, idempotent=idempotent, **kwargs)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure(endpoint)
+            raise
+        except BaseException:
+            self.breaker.release(endpoint)
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure(endpoint)
+        else:
+            self.breaker.record_success(endpoint)
+        return response
+
+    def _request(self, method: str, endpoint: str, *, idempotent: bool, **kwargs) -> requests.Response:
+        # Неидемпотентные запросы (create_order) повторяем только если соединение не было установлено,
+        # иначе провайдер мог уже принять заказ.
+        url = f"{self.base_url}/{endpoint}"
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, self.default_timeout))
+        retryable = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        if not idempotent:
+            retryable = (requests.exceptions.ConnectTimeout,)
+
+        # При включённом лимитере паузы между повторами задаёт он, а ответ 429 означает,
+        # что запрос не принят: его ставим обратно в очередь, пока не истечёт max_wait.
+        limiter = self.limiter
+        deadline = time.monotonic() + limiter.max_wait if limiter else 0.0
+
+        attempt = 0
+        while True:
+            if limiter:
+                metrics.observe("steamgifts_ratelimit_wait_seconds", limiter.acquire())
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except retryable as exc:
+                metrics.observe("steamgifts_http_seconds", time.perf_counter() - start, endpoint=endpoint)
+                metrics.inc("steamgifts_http_requests_total", endpoint=endpoint, status=type(exc).__name__)
+                if limiter:
+                    limiter.penalize()
+                if attempt >= self.retries:
+                    raise
+                logger.warning("[SteamGifts] %s %s failed (%s), retry %s", method, endpoint, exc, attempt + 1)
+            else:
+                metrics.observe("steamgifts_http_seconds", time.perf_counter() - start, endpoint=endpoint)
+                metrics.inc("steamgifts_http_requests_total", endpoint=endpoint, status=response.status_code)
+                status = response.status_code
+                if limiter and (status == 429 or status >= 500):
+                    limiter.penalize(parse_retry_after(response.headers.get("Retry-After")))
+                    if status == 429 and time.monotonic() < deadline:
+                        logger.warning("[SteamGifts] %s %s rate limited, request queued", method, endpoint)
+                        continue
+                elif limiter:
+                    limiter.reward()
+                if status < 500 or not idempotent or attempt >= self.retries:
+                    return response
+                logger.warning("[SteamGifts] %s %s -> HTTP %s, retry %s", method, endpoint, status, attempt + 1)
+            if not limiter:
+                time.sleep(self.backoff * (2**attempt))
+            attempt += 1
+
+    def close(self) -> None:
+        self.session.close()
+
+
 @dataclass
 class TokenCache:
     token: str | None = None
@@ -55,16 +733,61 @@ class TokenCache:
 
 
 class TokenManager:
-    def __init__(self, api_login: str, api_password: str):
+    def __init__(
+        self,
+        api_login: str,
+        api_password: str,
+        transport: HTTPTransport | None = None,
+        refresh_margin: float = 300,
+        cache_path: str | None = None,
+    ):
         self.api_login = api_login
         self.api_password = api_password
-        self.cache = TokenCache()
+        self.transport = transport or HTTPTransport()
+        self.refresh_margin = refresh_margin
+        self.cache_path = cache_path
+        self.cache = self._load_cache()
+        self._lock = threading.Lock()
 
     def get_token(self) -> str:
-        if self.cache.token and time.time() < self.cache.expiry:
+        with metrics.timer("steamgifts_api_seconds", call="get_token"):
+            return self._get_token()
+
+    def _get_token(self) -> str:
+        cache = self.cache
+        now = time.time()
+        if cache.token and now < cache.expiry:
+            if now >= cache.expiry - self.refresh_margin:
+                self._refresh_in_background()
             logger.debug("[SteamGifts] Используем кешированный токен")
-            return self.cache.token
+            return cache.token
+
+        with self._lock:
+            # Пока ждали блокировку, токен мог обновить другой поток
+            if self.cache.token and time.time() < self.cache.expiry:
+                return self.cache.token
+            return self._fetch_token()
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            if self.cache.token == token:
+                self.cache = TokenCache()
 
+    def _refresh_in_background(self) -> None:
+        if not self._lock.acquire(blocking=False):
+            return
+
+        def refresh() -> None:
+            try:
+                self._fetch_token()
+            except Exception as exc:
+                logger.warning("[SteamGifts] Фоновое обновление токена не удалось: %s", exc)
+            finally:
+                self._lock.release()
+
+        scheduler.call_soon(refresh)
+
+    def _fetch_token(self) -> str:
         logger.info("[SteamGifts] Запрос нового токена для %s", self.api_login)
         payload = {
             "email": self.api_login,
@@ -72,11 +795,7 @@ class TokenManager:
         }
 
         try:
-            response = requests.post(
-                f"{API_BASE_URL}/get_token",
-                json=payload,
-                timeout=10,
-            )
+            response = self.transport.request("POST", "get_token", json=payload)
             response.raise_for_status()
 
             data = response.json()
@@ -89,8 +808,8 @@ class TokenManager:
             if not token:
                 raise Exception(f"Токен не найден в ответе API: {data}")
 
-            self.cache.token = token
-            self.cache.expiry = data.get("valid_thru", time.time() + 7200)
+            self.cache = TokenCache(token, float(data.get("valid_thru", time.time() + 7200)))
+            self._save_cache()
 
             expiry_time = datetime.fromtimestamp(self.cache.expiry).strftime("%Y-%m-%d %H:%M:%S")
             logger.info("[SteamGifts] ✅ Токен получен, действителен до %s", expiry_time)
@@ -103,28 +822,78 @@ class TokenManager:
             if exc.response.status_code == 403:
                 raise Exception("Доступ запрещён")
             raise Exception(f"HTTP {exc.response.status_code}: {exc.response.text}")
+        except ProviderUnavailable:
+            # Цепь разомкнута: заказ должен быть отложен, а не завершён ошибкой
+            raise
         except Exception as exc:
             logger.error("[SteamGifts] Ошибка получения токена: %s", exc)
             raise Exception(f"Не удалось получить токен: {str(exc)}")
 
+    def _load_cache(self) -> TokenCache:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return TokenCache()
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as exc:
+            logger.warning("[SteamGifts] Token cache read error: %s", exc)
+            return TokenCache()
+        if data.get("login") != self.api_login or time.time() >= data.get("expiry", 0):
+            return TokenCache()
+        return TokenCache(data.get("token"), data.get("expiry", 0.0))
+
+    def _save_cache(self) -> None:
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump({"login": self.api_login, "token": self.cache.token, "expiry": self.cache.expiry}, file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as exc:
+            logger.warning("[SteamGifts] Token cache write error: %s", exc)
+
 
 class NSGiftsAPIClient:
     """Клиент для работы с NS.Gifts API через JWT авторизацию"""
 
-    def __init__(self, token_manager: TokenManager):
+    def __init__(
+        self,
+        token_manager: TokenManager,
+        transport: HTTPTransport | None = None,
+        ledger: DispatchLedger | None = None,
+    ):
         self.token_manager = token_manager
+        self.transport = transport or token_manager.transport
+        self.ledger = ledger
 
-    def _get_headers(self) -> dict:
-        token = self.token_manager.get_token()
+    def _get_headers(self, token: str) -> dict:
         return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {token}",
         }
 
+    def _request(self, method: str, endpoint: str, headers: dict | None = None, **kwargs) -> requests.Response:
+        token = self.token_manager.get_token()
+        response = self.transport.request(
+            method, endpoint, headers={**self._get_headers(token), **(headers or {})}, **kwargs
+        )
+        if response.status_code == 401:
+            logger.info("[SteamGifts] Token rejected on %s, retrying with a fresh one", endpoint)
+            self.token_manager.invalidate(token)
+            token = self.token_manager.get_token()
+            response = self.transport.request(
+                method, endpoint, headers={**self._get_headers(token), **(headers or {})}, **kwargs
+            )
+        return response
+
     def get_balance(self) -> float:
+        with metrics.timer("steamgifts_api_seconds", call="get_balance"):
+            return self._get_balance()
+
+    def _get_balance(self) -> float:
         try:
-            url = f"{API_BASE_URL}/check_balance"
-            response = requests.get(url, headers=self._get_headers(), timeout=10)
+            response = self._request("GET", "check_balance")
             response.raise_for_status()
             data = response.json()
 
@@ -135,19 +904,97 @@ class NSGiftsAPIClient:
             logger.error("[SteamGifts] Balance check error: %s", exc)
             raise
 
-    def send_gift(self, steam_link: str, game_name: str, region: str = "ru") -> dict:
-        try:
-            url = f"{API_BASE_URL}/steam_gift/create_order"
+    def send_gift(
+        self,
+        steam_link: str,
+        game_name: str,
+        region: str = "ru",
+        sub_id: int = 0,
+        idempotency_key: str | None = None,
+    ) -> dict:
+        ledger = self.ledger if idempotency_key else None
+        if ledger and not ledger.begin(idempotency_key):
+            logger.warning("[SteamGifts] Gift %s was already dispatched, not sending again", idempotency_key)
+            metrics.inc("steamgifts_duplicates_blocked_total")
+            return {"success": False, "error": "Гифт уже отправлялся", "unknown": True}
+
+        with metrics.timer("steamgifts_api_seconds", call="send_gift"):
+            result = self._send_gift(steam_link, game_name, region, sub_id, idempotency_key)
+
+        if result["success"]:
+            data = result["data"]
+            result["provider_order_id"] = data.get("order_id") or data.get("id")
+            result["provider_status"] = str(data.get("status") or "created").lower()
+
+        if ledger:
+            if result["success"]:
+                ledger.finish(
+                    idempotency_key,
+                    ledger.SENT,
+                    provider_order_id=result["provider_order_id"],
+                    provider_status=result["provider_status"],
+                )
+            else:
+                ledger.finish(idempotency_key, ledger.UNKNOWN if result.get("unknown") else ledger.FAILED)
+
+        if not result["success"]:
+            cause = "unavailable" if result.get("unavailable") else error_cause(result["error"])
+            metrics.inc("steamgifts_errors_total", cause=cause)
+        return result
+
+    def get_order_statuses(self, provider_ids: list[str], endpoint: str) -> dict[str, str]:
+        with metrics.timer("steamgifts_api_seconds", call="order_status"):
+            response = self._request("POST", endpoint, json={"order_ids": provider_ids})
+        response.raise_for_status()
+        data = response.json()
+
+        orders = data.get("orders", data.get("data", []))
+        if isinstance(orders, dict):
+            return {str(order_id): str(status).lower() for order_id, status in orders.items()}
+        return {
+            str(order.get("order_id") or order.get("id")): str(order.get("status", "")).lower()
+            for order in orders
+            if isinstance(order, dict)
+        }
+
+    # Ответы шлюза перед провайдером: заказ мог быть принят, а ответ потерян
+    GATEWAY_ERRORS = (502, 504)
+
+    @staticmethod
+    def reached_provider(exc: Exception) -> bool:
+        # Таймаут чтения, обрыв соединения или 5xx без ответа самого провайдера: провайдер мог принять заказ
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+            status = exc.response.status_code
+            if status < 500:
+                return False
+            if status in NSGiftsAPIClient.GATEWAY_ERRORS:
+                return True
+            try:
+                data = exc.response.json()
+            except ValueError:
+                return True
+            return not (isinstance(data, dict) and (data.get("error") or data.get("success") is False))
+        if isinstance(exc, requests.exceptions.ConnectTimeout):
+            return False
+        if isinstance(exc, requests.exceptions.ConnectionError):
+            reason = getattr(exc.args[0], "reason", None) if exc.args else None
+            return not isinstance(reason, NewConnectionError)
+        return isinstance(exc, requests.exceptions.Timeout)
 
+    def _send_gift(self, steam_link: str, game_name: str, region: str, sub_id: int, idempotency_key: str | None) -> dict:
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        try:
             payload = {
                 "friendLink": steam_link,
-                "sub_id": 0,
+                "sub_id": sub_id,
                 "region": region,
                 "giftName": game_name,
                 "giftDescription": "Спасибо за покупку!",
             }
 
-            response = requests.post(url, json=payload, headers=self._get_headers(), timeout=30)
+            response = self._request(
+                "POST", "steam_gift/create_order", idempotent=False, headers=headers, json=payload
+            )
             response.raise_for_status()
             data = response.json()
 
@@ -157,10 +1004,1640 @@ class NSGiftsAPIClient:
             error = data.get("error", "Unknown error")
             raise Exception(f"API error: {error}")
 
+        except ProviderUnavailable as exc:
+            # Запрос не уходил к провайдеру, заказ можно безопасно отложить
+            return {"success": False, "error": str(exc), "unavailable": True}
+
         except Exception as exc:
             logger.error("[SteamGifts] Gift send error: %s", exc)
+            if self.reached_provider(exc):
+                return {"success": False, "error": str(exc), "unknown": True}
             return {"success": False, "error": str(exc)}
 
+    def send_gifts(self, items: list[dict], max_parallel: int = 4) -> list[dict]:
+        # Гифты одного заказа: после ответа о нехватке баланса оставшиеся не отправляются
+        results: list[dict] = [{}] * len(items)
+        exhausted: list[dict] = []
+
+        def send(index: int) -> None:
+            if exhausted:
+                results[index] = exhausted[0]
+                return
+            result = self.send_gift(**items[index])
+            results[index] = result
+            if not result["success"] and "balance" in result.get("error", "").lower():
+                exhausted.append(result)
+
+        workers = max(1, min(max_parallel, len(items)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SteamGifts-batch") as pool:
+            list(pool.map(send, range(len(items))))
+        return results
+
+
+class TTLCache:
+    """LRU-кэш с ограничением времени жизни записей"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if time.time() >= expires:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+@dataclass(frozen=True)
+class SteamLink:
+    kind: str
+    value: str
+
+    @property
+    def url(self) -> str:
+        return f"https://steamcommunity.com/{self.kind}/{self.value}"
+
+
+class SteamLinkParser:
+    """Поиск, проверка и нормализация ссылок на Steam профиль"""
+
+    LINK_RE = re.compile(
+        r"(?<![\w./-])(?:https?://)?(?:www\.|m\.)?steamcommunity\.com/"
+        r"(?:id/(?P<vanity>[A-Za-z0-9_-]{2,32})|profiles/(?P<steamid>7656119\d{10}))"
+        # Точка допустима только в конце предложения: id/foo.bar — другой, некорректный профиль, а не id/foo
+        r"(?=[/?#\s,;!)\"']|\.(?![\w-])|$)",
+        re.IGNORECASE,
+    )
+
+    def __init__(self, resolver=None, cache: TTLCache | None = None):
+        self.resolver = resolver
+        self.cache = cache or TTLCache(maxsize=4096, ttl=86400)
+
+    def parse(self, text: str) -> SteamLink | None:
+        match = self.LINK_RE.search(text)
+        if not match:
+            return None
+        if match.group("steamid"):
+            return SteamLink("profiles", match.group("steamid"))
+        return SteamLink("id", match.group("vanity"))
+
+    def needs_lookup(self, link: SteamLink) -> bool:
+        return link.kind == "id" and self.resolver is not None and self.cache.get(link.value.lower()) is None
+
+    def resolve(self, link: SteamLink) -> SteamLink | None:
+        if link.kind != "id" or self.resolver is None:
+            return link
+
+        key = link.value.lower()
+        steam_id = self.cache.get(key)
+        if steam_id is None:
+            try:
+                steam_id = self.resolver(link.value) or ""
+            except Exception as exc:
+                logger.warning("[SteamGifts] Vanity resolve error for %s: %s", link.value, exc)
+                return link
+            self.cache.set(key, steam_id)
+
+        if not steam_id:
+            return None
+        return SteamLink("profiles", steam_id)
+
+
+class SteamVanityResolver:
+    """Резолвер /id/ ссылок в SteamID64 через Steam Web API"""
+
+    URL = "https://api.steampowered.com/ISteamUser/ResolveVanityURL/v1/"
+
+    def __init__(self, api_key: str, timeout: float = 5):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def __call__(self, vanity: str) -> str | None:
+        response = self.session.get(self.URL, params={"key": self.api_key, "vanityurl": vanity}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json().get("response", {})
+        if data.get("success") == 1:
+            return data.get("steamid")
+        return None
+
+
+class BalanceCache:
+    """Кэш баланса ns.gifts с локальным списанием и периодической сверкой"""
+
+    def __init__(self, fetch, ttl: float = 300, low_threshold: float = 0.0, on_low=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.low_threshold = low_threshold
+        self.on_low = on_low
+        self.value: float | None = None
+        self.fetched_at = 0.0
+        # Зарезервировано под отправки, которые ещё не завершились и не видны в балансе провайдера
+        self.held = 0.0
+        self._lock = threading.Lock()
+        self._low_notified = False
+        self._refreshing = False
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    @property
+    def stale(self) -> bool:
+        return self.value is None or self.age >= self.ttl
+
+    def get(self, force: bool = False) -> float:
+        if force or self.stale:
+            return self.refresh()
+        return self.value
+
+    def refresh(self) -> float:
+        value = self.fetch()
+        with self._lock:
+            self.value = value - self.held
+            self.fetched_at = time.time()
+            value = self.value
+        self._check_low()
+        return value
+
+    def refresh_soon(self) -> None:
+        # Устаревший баланс перечитывается в фоне, отправка идёт по кэшированному значению
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        scheduler.call_soon(self._refresh_in_background)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.fetched_at = 0.0
+
+    def reserve(self, cost: float | None) -> bool:
+        # Проверка и списание под одной блокировкой: параллельные отправки не тратят один остаток дважды
+        if self.value is None:
+            try:
+                self.refresh()
+            except Exception as exc:
+                logger.warning("[SteamGifts] Balance refresh failed: %s", exc)
+        elif self.stale:
+            self.refresh_soon()
+        with self._lock:
+            if self.value is None:
+                return True
+            if cost is None:
+                # Стоимость неизвестна: списать нечего, решает кэшированный остаток
+                return self.value > 0
+            if self.value < cost:
+                return False
+            self.value -= cost
+            self.held += cost
+        self._check_low()
+        return True
+
+    def commit(self, cost: float | None) -> None:
+        if not cost:
+            return
+        with self._lock:
+            self.held = max(0.0, self.held - cost)
+
+    def release(self, cost: float | None) -> None:
+        if not cost:
+            return
+        with self._lock:
+            self.held = max(0.0, self.held - cost)
+            if self.value is not None:
+                self.value += cost
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as exc:
+            logger.warning("[SteamGifts] Balance refresh failed, using cached value: %s", exc)
+        finally:
+            self._refreshing = False
+
+    def _check_low(self) -> None:
+        if not self.low_threshold or self.value is None:
+            return
+        if self.value >= self.low_threshold:
+            self._low_notified = False
+            return
+        if not self._low_notified:
+            self._low_notified = True
+            if self.on_low:
+                self.on_low(self.value)
+
+
+class GiftDispatcher:
+    """Пул потоков, отправляющий подтверждённые заказы вне обработчика сообщений"""
+
+    def __init__(self, workers: int = 4):
+        self.workers = max(1, int(workers))
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._active: set[int] = set()
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._active)
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"SteamGifts-dispatch-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, order_id: int, func, *args) -> bool:
+        with self._lock:
+            if order_id in self._active:
+                return False
+            self._active.add(order_id)
+        self._queue.put((order_id, func, args, time.perf_counter()))
+        return True
+
+    def is_active(self, order_id: int) -> bool:
+        with self._lock:
+            return order_id in self._active
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            order_id, func, args, queued_at = item
+            metrics.observe("steamgifts_stage_seconds", time.perf_counter() - queued_at, stage="dispatch_wait")
+            try:
+                func(*args)
+            except Exception as exc:
+                logger.error("[SteamGifts] Dispatch error for order %s: %s", order_id, exc)
+            finally:
+                with self._lock:
+                    self._active.discard(order_id)
+                self._queue.task_done()
+
+    def stop(self, timeout: float = 30) -> None:
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.time()))
+        self._threads.clear()
+
+
+class ChatOutbox:
+    """Очередь исходящих сообщений FunPay: порядок внутри чата, общий лимит, склейка подряд идущих"""
+
+    def __init__(
+        self,
+        send,
+        limiter: RateLimiter | None = None,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_length: int = 2000,
+    ):
+        self._send = send
+        self.limiter = limiter
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.max_length = max_length
+        self._chats: OrderedDict[int, deque] = OrderedDict()
+        # Пачки, ожидающие повторной отправки: чат -> (время повтора, пачка, номер попытки).
+        # Пока пачка ждёт, остальные сообщения этого чата не отправляются.
+        self._retry: dict[int, tuple[float, list, int]] = {}
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def from_config(cls, send, config: dict) -> ChatOutbox:
+        options = config.get("outbox", {})
+        return cls(
+            send,
+            limiter=RateLimiter.from_config(options),
+            retries=options.get("retries", 3),
+            backoff=options.get("backoff", 1.0),
+            max_length=options.get("max_length", 2000),
+        )
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._worker, name="SteamGifts-outbox", daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id: int, text: str, on_sent=None) -> None:
+        # on_sent вызывается из потока очереди после успешной отправки сообщения
+        with self._cond:
+            self._chats.setdefault(chat_id, deque()).append((text, time.perf_counter(), on_sent))
+            self._pending += 1
+            self._cond.notify()
+
+    def stop(self, timeout: float = 10) -> None:
+        # Оставшиеся сообщения отправляются до выхода
+        if not self._thread:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    chat_id = next((chat for chat, (when, _, _) in self._retry.items() if when <= now), None)
+                    if chat_id is not None:
+                        _, batch, attempt = self._retry.pop(chat_id)
+                        self._pending -= len(batch)
+                        break
+                    chat_id = next((chat for chat in self._chats if chat not in self._retry), None)
+                    if chat_id is not None:
+                        messages = self._chats.pop(chat_id)
+                        batch, attempt = self._take(messages), 0
+                        if messages:
+                            self._chats[chat_id] = messages
+                        break
+                    if self._stopping and not self._chats and not self._retry:
+                        return
+                    wake = min((when for when, _, _ in self._retry.values()), default=None)
+                    self._cond.wait(wake - now if wake is not None else None)
+            self._deliver(chat_id, batch, attempt)
+
+    def _take(self, messages: deque) -> list[tuple[str, float, list]]:
+        batch: list[tuple[str, float, list]] = []
+        length = 0
+        while messages:
+            text, queued_at, on_sent = messages[0]
+            if batch and length + len(text) + 2 > self.max_length:
+                break
+            messages.popleft()
+            self._pending -= 1
+            if batch and batch[-1][0] == text:
+                metrics.inc("steamgifts_outbox_coalesced_total")
+                if on_sent:
+                    batch[-1][2].append(on_sent)
+                continue
+            batch.append((text, queued_at, [on_sent] if on_sent else []))
+            length += len(text) + 2
+        if len(batch) > 1:
+            metrics.inc("steamgifts_outbox_coalesced_total", len(batch) - 1)
+        return batch
+
+    def _deliver(self, chat_id: int, batch: list[tuple[str, float, list]], attempt: int) -> None:
+        text = "\n\n".join(text for text, _, _ in batch)
+        if self.limiter:
+            self.limiter.acquire()
+        try:
+            self._send(chat_id, text)
+        except Exception as exc:
+            if self.limiter:
+                self.limiter.penalize()
+            if attempt >= self.retries:
+                metrics.inc("steamgifts_errors_total", cause="send_message")
+                logger.error("[SteamGifts] Message to chat %s dropped: %s", chat_id, exc)
+                return
+            logger.warning("[SteamGifts] Send to chat %s failed (%s), retry %s", chat_id, exc, attempt + 1)
+            # Повтор откладывается, а не ждёт в потоке очереди: остальные чаты отправляются без задержки
+            with self._cond:
+                self._retry[chat_id] = (time.monotonic() + self.backoff * (2**attempt), batch, attempt + 1)
+                self._pending += len(batch)
+                self._cond.notify()
+            return
+
+        if self.limiter:
+            self.limiter.reward()
+        now = time.perf_counter()
+        for _, queued_at, callbacks in batch:
+            metrics.observe("steamgifts_outbox_wait_seconds", now - queued_at)
+            for on_sent in callbacks:
+                try:
+                    on_sent()
+                except Exception as exc:
+                    logger.error("[SteamGifts] Outbox callback error for chat %s: %s", chat_id, exc)
+        metrics.inc("steamgifts_outbox_sent_total")
+
+
+@dataclass(frozen=True)
+class OrderInfo:
+    order_id: str
+    chat_id: int
+    buyer_id: int
+    revenue: float
+    quantity: int = 1
+    buyer_username: str = ""
+    status: str = ""
+
+    @classmethod
+    def from_funpay(cls, order_id, order) -> OrderInfo:
+        chat_id = getattr(order, "chat_id", None)
+        if chat_id is None:
+            chat_id = getattr(getattr(order, "chat", None), "id", None)
+        if chat_id is None:
+            raise ValueError("No chat_id")
+
+        buyer_id = getattr(order, "buyer_id", None)
+        if buyer_id is None:
+            raise ValueError("No buyer_id")
+
+        revenue = getattr(order, "sum", None)
+        if revenue is None:
+            raise ValueError("No sum")
+
+        status = getattr(order, "status", "")
+        return cls(
+            order_id=order_id,
+            chat_id=chat_id,
+            buyer_id=buyer_id,
+            revenue=revenue,
+            quantity=max(1, int(getattr(order, "amount", None) or 1)),
+            buyer_username=getattr(order, "buyer_username", None) or "",
+            status=str(getattr(status, "name", status)).lower(),
+        )
+
+
+class OrderFetcher:
+    """Загрузка заказов FunPay вне обработчика событий, с повторами и кэшем"""
+
+    def __init__(
+        self,
+        fetch,
+        on_error=None,
+        workers: int = 2,
+        retries: int = 3,
+        backoff: float = 1.0,
+        ttl: float = 3600,
+    ):
+        self.fetch = fetch
+        self.on_error = on_error
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.cache = TTLCache(maxsize=1024, ttl=ttl)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="SteamGifts-orders")
+        self._lock = threading.Lock()
+        self._inflight: set = set()
+
+    @classmethod
+    def from_config(cls, fetch, config: dict, on_error=None) -> OrderFetcher:
+        options = config.get("order_fetch", {})
+        return cls(
+            fetch,
+            on_error=on_error,
+            workers=options.get("workers", 2),
+            retries=options.get("retries", 3),
+            backoff=options.get("backoff", 1.0),
+            ttl=options.get("cache_ttl", 3600),
+        )
+
+    def cached(self, order_id) -> OrderInfo | None:
+        return self.cache.get(order_id)
+
+    def get(self, order_id) -> OrderInfo:
+        info = self.cache.get(order_id)
+        if info is not None:
+            return info
+
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer("steamgifts_stage_seconds", stage="get_order"):
+                    order = self.fetch(order_id)
+                break
+            except Exception as exc:
+                metrics.inc("steamgifts_errors_total", cause="get_order")
+                if attempt >= self.retries:
+                    raise
+                logger.warning("[SteamGifts] Get order %s failed (%s), retry %s", order_id, exc, attempt + 1)
+                time.sleep(self.backoff * (2**attempt))
+                attempt += 1
+
+        info = OrderInfo.from_funpay(order_id, order)
+        self.cache.set(order_id, info)
+        return info
+
+    def submit(self, order_id, callback, *args) -> bool:
+        with self._lock:
+            if order_id in self._inflight:
+                return False
+            self._inflight.add(order_id)
+        self._pool.submit(self._run, order_id, callback, args)
+        return True
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+
+    def _run(self, order_id, callback, args: tuple) -> None:
+        try:
+            info = self.get(order_id)
+        except Exception as exc:
+            logger.error("[SteamGifts] Get order error for %s: %s", order_id, exc)
+            if self.on_error:
+                self.on_error(order_id, exc)
+        else:
+            try:
+                callback(*args, info)
+            except Exception as exc:
+                logger.error("[SteamGifts] Order %s handler error: %s", order_id, exc)
+        finally:
+            with self._lock:
+                self._inflight.discard(order_id)
+
+
+class ConversationStore:
+    """Открытые заказы, проиндексированные по покупателю и чату"""
+
+    # Порядок выбора заказа, если у покупателя их несколько: сначала ожидающие подтверждения,
+    # затем ожидающие ссылку, затем уже отправляемые; внутри шага — по времени создания.
+    STEP_PRIORITY = {"await_confirm": 0, "await_link": 1, "dispatching": 2}
+    # Шаги, в которых заказ ждёт ответа покупателя и может устареть
+    IDLE_STEPS = ("await_link", "await_confirm")
+
+    def __init__(self, persistence: PendingOrderStore | None = None) -> None:
+        self.persistence = persistence
+        self._lock = threading.RLock()
+        self._orders: dict[int, dict] = {}
+        self._by_buyer: dict[int, list[int]] = {}
+        self._by_chat: dict[int, list[int]] = {}
+        # Очереди по времени последней активности: ещё не напомненные и уже напомненные заказы.
+        # Обход идёт с головы и останавливается на первом свежем заказе.
+        self._idle: OrderedDict[int, float] = OrderedDict()
+        self._reminded: OrderedDict[int, float] = OrderedDict()
+        # Заказы, отложенные до восстановления провайдера
+        self._parked: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._orders
+
+    def get(self, order_id: int) -> dict | None:
+        return self._orders.get(order_id)
+
+    def values(self) -> list[dict]:
+        with self._lock:
+            return list(self._orders.values())
+
+    @property
+    def parked_count(self) -> int:
+        return len(self._parked)
+
+    def parked(self) -> list[dict]:
+        with self._lock:
+            parked = [self._orders[order_id] for order_id in self._parked]
+        return sorted(parked, key=lambda data: data.get("parked_at", 0))
+
+    def has_buyer(self, buyer_id: int) -> bool:
+        return buyer_id in self._by_buyer
+
+    def add(self, data: dict, persist: bool = True) -> None:
+        order_id = data["order_id"]
+        with self._lock:
+            if order_id in self._orders:
+                self._unindex(self._orders[order_id])
+            self._orders[order_id] = data
+            self._by_buyer.setdefault(data["buyer_id"], []).append(order_id)
+            self._by_chat.setdefault(data["chat_id"], []).append(order_id)
+            self._touch(data, data.get("step_at") or time.time())
+            if persist and self.persistence:
+                self.persistence.record(**data)
+
+    def update(self, order_id: int, **fields) -> dict | None:
+        with self._lock:
+            data = self._orders.get(order_id)
+            if data is None:
+                return None
+            # Таймер бездействия перезапускается только при смене шага
+            step_changed = fields.get("step", data["step"]) != data["step"]
+            data.update(fields)
+            if step_changed:
+                self._touch(data, time.time())
+            if self.persistence:
+                self.persistence.record(order_id, **fields)
+            return data
+
+    def finish(self, order_id: int, step: str = "done") -> dict | None:
+        with self._lock:
+            data = self._orders.pop(order_id, None)
+            if data is None:
+                return None
+            self._unindex(data)
+            if self.persistence:
+                self.persistence.record(order_id, step=step)
+            return data
+
+    def expire(self, order_id: int) -> dict | None:
+        # Заказ из due_expiry закрывается, только если за это время покупатель не ответил:
+        # шаг по-прежнему ожидающий и заказ не вернулся в очереди активности
+        with self._lock:
+            data = self._orders.get(order_id)
+            if data is None or data["step"] not in self.IDLE_STEPS:
+                return None
+            if order_id in self._idle or order_id in self._reminded:
+                return None
+            return self.finish(order_id, "expired")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._orders.clear()
+            self._by_buyer.clear()
+            self._by_chat.clear()
+            self._idle.clear()
+            self._reminded.clear()
+            self._parked.clear()
+
+    def due_reminders(self, idle_before: float) -> list[dict]:
+        due = []
+        with self._lock:
+            now = time.time()
+            while self._idle:
+                order_id, since = next(iter(self._idle.items()))
+                if since > idle_before:
+                    break
+                del self._idle[order_id]
+                self._reminded[order_id] = now
+                due.append(self._orders[order_id])
+        return due
+
+    def due_expiry(self, reminded_before: float) -> list[dict]:
+        due = []
+        with self._lock:
+            while self._reminded:
+                order_id, since = next(iter(self._reminded.items()))
+                if since > reminded_before:
+                    break
+                del self._reminded[order_id]
+                due.append(self._orders[order_id])
+        return due
+
+    def _touch(self, data: dict, now: float) -> None:
+        order_id = data["order_id"]
+        self._reminded.pop(order_id, None)
+        self._idle.pop(order_id, None)
+        self._parked.discard(order_id)
+        if data["step"] in self.IDLE_STEPS:
+            self._idle[order_id] = now
+        elif data["step"] == "parked":
+            self._parked.add(order_id)
+
+    def resolve(self, buyer_id: int, chat_id: int) -> dict | None:
+        order_ids = self._by_buyer.get(buyer_id)
+        if not order_ids:
+            return None
+
+        with self._lock:
+            # Сначала заказы этого покупателя в текущем чате, иначе любые его заказы
+            candidates = [
+                self._orders[order_id]
+                for order_id in self._by_chat.get(chat_id, ())
+                if self._orders[order_id]["buyer_id"] == buyer_id
+            ] or [self._orders[order_id] for order_id in self._by_buyer.get(buyer_id, ())]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda data: self.STEP_PRIORITY.get(data["step"], len(self.STEP_PRIORITY)))
+
+    def _unindex(self, data: dict) -> None:
+        self._idle.pop(data["order_id"], None)
+        self._reminded.pop(data["order_id"], None)
+        self._parked.discard(data["order_id"])
+        for index, key in ((self._by_buyer, data["buyer_id"]), (self._by_chat, data["chat_id"])):
+            order_ids = index.get(key)
+            if not order_ids:
+                continue
+            try:
+                order_ids.remove(data["order_id"])
+            except ValueError:
+                pass
+            if not order_ids:
+                del index[key]
+
+
+class JsonlFile:
+    """Append-only файл JSON Lines с политикой fsync и ротацией по размеру"""
+
+    FSYNC_POLICIES = ("always", "interval", "never")
+
+    def __init__(
+        self,
+        path: str,
+        fsync: str = "interval",
+        fsync_interval: float = 1.0,
+        max_bytes: int = 0,
+        backups: int = 0,
+    ):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.RLock()
+        self._file = None
+        self._last_fsync = 0.0
+
+    def rotated_files(self) -> list[str]:
+        files = []
+        for path in glob.glob(f"{glob.escape(self.path)}.*"):
+            suffix = path[len(self.path) + 1 :]
+            if suffix.isdigit():
+                files.append((int(suffix), path))
+        return [path for _, path in sorted(files)]
+
+    def append(self, record: dict) -> None:
+        self.extend([record])
+
+    def extend(self, records: list[dict]) -> None:
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(lines)
+            self._file.flush()
+            self._sync(force=self.fsync == "always")
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def iter_records(self):
+        for path in [*self.rotated_files(), self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("[SteamGifts] Skipping corrupt journal line in %s", path)
+
+    def rewrite(self, records: list[dict]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                file.flush()
+                if self.fsync != "never":
+                    os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync(force=self.fsync != "never")
+                self._file.close()
+                self._file = None
+
+    def _sync(self, force: bool = False) -> None:
+        if self.fsync == "never":
+            return
+        now = time.time()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def _rotate(self) -> None:
+        self._sync(force=self.fsync != "never")
+        self._file.close()
+        self._file = None
+
+        rotated = self.rotated_files()
+        last_index = int(rotated[-1].rsplit(".", 1)[1]) if rotated else 0
+        os.replace(self.path, f"{self.path}.{last_index + 1}")
+        rotated.append(f"{self.path}.{last_index + 1}")
+
+        if self.backups:
+            for path in rotated[: -self.backups]:
+                os.remove(path)
+
+
+class OrderJournal(JsonlFile):
+    """Журнал выполненных заказов"""
+
+    def __init__(self, path: str, **options):
+        super().__init__(path, **options)
+        self.count = 0
+        self.last_seq = 0
+        for _ in self.iter_since(0):
+            self.count += 1
+
+    @classmethod
+    def from_config(cls, path: str, config: dict) -> OrderJournal:
+        options = config.get("journal", {})
+        return cls(
+            path,
+            fsync=options.get("fsync", "interval"),
+            fsync_interval=options.get("fsync_interval", 1.0),
+            max_bytes=options.get("max_bytes", 0),
+            backups=options.get("backups", 0),
+        )
+
+    def extend(self, records: list[dict]) -> None:
+        with self._lock:
+            for record in records:
+                self.last_seq += 1
+                record["seq"] = self.last_seq
+            super().extend(records)
+            self.count += len(records)
+
+    def iter_since(self, seq: int):
+        # Записи до введения seq нумеруются по порядку в журнале
+        last_seq = 0
+        for record in self.iter_records():
+            last_seq = record.setdefault("seq", last_seq + 1)
+            self.last_seq = max(self.last_seq, last_seq)
+            if last_seq > seq:
+                yield record
+
+    def migrate(self, history: list[dict]) -> int:
+        if not history or self.count:
+            return 0
+        self.extend(history)
+        return len(history)
+
+
+class OrderStats:
+    """Накопительная статистика заказов, обновляемая по мере их выполнения"""
+
+    def __init__(self, store: ConfigStore):
+        self.store = store
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def empty() -> dict:
+        return {
+            "last_seq": 0,
+            "total_orders": 0,
+            "total_revenue": 0.0,
+            "by_game": {},
+            "by_region": {},
+            "by_day": {},
+        }
+
+    @property
+    def data(self) -> dict:
+        return self.store.config
+
+    @property
+    def total_orders(self) -> int:
+        return self.data["total_orders"]
+
+    @property
+    def total_revenue(self) -> float:
+        return self.data["total_revenue"]
+
+    def load(self, journal: OrderJournal) -> None:
+        self.store.load()
+        if self.data["last_seq"] > journal.last_seq:
+            # Журнал восстановлен из копии или усечён: статистика опережает его
+            logger.warning(
+                "[SteamGifts] Stats are ahead of the journal (%s > %s), rebuilding",
+                self.data["last_seq"],
+                journal.last_seq,
+            )
+            self.rebuild(journal)
+            return
+        self._replay(journal)
+
+    def rebuild(self, journal: OrderJournal) -> None:
+        with self._lock:
+            self.store.config = self.empty()
+        self._replay(journal)
+        self.store.save()
+
+    def _replay(self, journal: OrderJournal) -> None:
+        replayed = 0
+        with self._lock:
+            for record in journal.iter_since(self.data["last_seq"]):
+                self._apply(record)
+                replayed += 1
+        if replayed:
+            logger.info("[SteamGifts] Stats caught up with %s journal records", replayed)
+            self.store.save()
+
+    def add(self, record: dict) -> None:
+        with self._lock:
+            self._apply(record)
+        self.store.save()
+
+    def top(self, group: str, k: int = 5) -> list[tuple[str, int]]:
+        return heapq.nlargest(k, self.data[group].items(), key=lambda item: item[1])
+
+    def _apply(self, record: dict) -> None:
+        data = self.data
+        # Запись со статусом reversed отменяет ранее учтённый заказ
+        sign = -1 if record.get("reversed") else 1
+        revenue = (record.get("revenue") or 0) * sign
+        game = record.get("game_name", "Unknown")
+        region = record.get("region", "ru")
+        day = str(record.get("timestamp", ""))[:10] or "unknown"
+
+        data["total_orders"] += sign
+        data["total_revenue"] += revenue
+        for group, key in (("by_game", game), ("by_region", region)):
+            count = data[group].get(key, 0) + sign
+            if count:
+                data[group][key] = count
+            else:
+                data[group].pop(key, None)
+        day_stats = data["by_day"].setdefault(day, [0, 0.0])
+        day_stats[0] += sign
+        day_stats[1] += revenue
+        data["last_seq"] = max(data["last_seq"], record.get("seq", 0))
+
+
+class OrderAnalytics:
+    """Колоночное представление заказов для выборок по времени и группировок"""
+
+    COLUMNS = ("game", "region", "lot")
+    RECORD_KEYS = {"game": "game_name", "region": "region", "lot": "lot_id"}
+
+    def __init__(self, reversible: bool = True) -> None:
+        self._lock = threading.Lock()
+        # Отменённые заказы хранятся отдельно и вычитаются из выборок, основные колонки не меняются
+        self.reversals: OrderAnalytics | None = OrderAnalytics(reversible=False) if reversible else None
+        self.ts = array("d")
+        self.revenue = array("d")
+        self.ids = {column: array("I") for column in self.COLUMNS}
+        self.names: dict[str, list[str]] = {column: [] for column in self.COLUMNS}
+        self._index: dict[str, dict[str, int]] = {column: {} for column in self.COLUMNS}
+        self._sorted = True
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    @staticmethod
+    def record_time(record: dict) -> float:
+        if record.get("ts"):
+            return float(record["ts"])
+        try:
+            return datetime.strptime(record.get("timestamp", ""), "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return 0.0
+
+    def load(self, records) -> None:
+        for record in records:
+            self.add(record)
+
+    def add(self, record: dict) -> None:
+        if self.reversals is not None and record.get("reversed"):
+            self.reversals.add(record)
+            return
+        ts = self.record_time(record)
+        with self._lock:
+            if self.ts and ts < self.ts[-1]:
+                self._sorted = False
+            self.ts.append(ts)
+            self.revenue.append(float(record.get("revenue") or 0))
+            for column in self.COLUMNS:
+                value = str(record.get(self.RECORD_KEYS[column]) or "unknown")
+                self.ids[column].append(self._intern(column, value))
+
+    def summary(self, since: float | None = None, until: float | None = None) -> tuple[int, float]:
+        with self._lock:
+            lo, hi = self._range(since, until)
+            count, revenue = hi - lo, sum(self.revenue[lo:hi])
+        if self.reversals is not None and len(self.reversals):
+            reversed_count, reversed_revenue = self.reversals.summary(since, until)
+            return count - reversed_count, revenue - reversed_revenue
+        return count, revenue
+
+    def group_by(
+        self, column: str, since: float | None = None, until: float | None = None
+    ) -> dict[str, tuple[int, float]]:
+        with self._lock:
+            lo, hi = self._range(since, until)
+            ids = self.ids[column][lo:hi]
+            counts = Counter(ids)
+            revenue: dict[int, float] = dict.fromkeys(counts, 0.0)
+            for value_id, amount in zip(ids, self.revenue[lo:hi]):
+                revenue[value_id] += amount
+            names = self.names[column]
+            groups = {names[value_id]: (count, revenue[value_id]) for value_id, count in counts.items()}
+        if self.reversals is not None and len(self.reversals):
+            for name, (count, amount) in self.reversals.group_by(column, since, until).items():
+                kept_count, kept_revenue = groups.pop(name, (0, 0.0))
+                if kept_count != count:
+                    groups[name] = (kept_count - count, kept_revenue - amount)
+        return groups
+
+    def hourly(self, since: float, until: float) -> list[tuple[float, int]]:
+        start = since - since % 3600
+        with self._lock:
+            lo, hi = self._range(start, until)
+            buckets = Counter(int((ts - start) // 3600) for ts in self.ts[lo:hi])
+        if self.reversals is not None and len(self.reversals):
+            for hour, count in self.reversals.hourly(start, until):
+                buckets[int((hour - start) // 3600)] -= count
+        hours = int((until - start) // 3600) + 1
+        return [(start + hour * 3600, buckets.get(hour, 0)) for hour in range(hours)]
+
+    def _intern(self, column: str, value: str) -> int:
+        index = self._index[column]
+        value_id = index.get(value)
+        if value_id is None:
+            value_id = index[value] = len(self.names[column])
+            self.names[column].append(value)
+        return value_id
+
+    def _range(self, since: float | None, until: float | None) -> tuple[int, int]:
+        if not self._sorted:
+            self._sort()
+        lo = 0 if since is None else bisect_left(self.ts, since)
+        hi = len(self.ts) if until is None else bisect_left(self.ts, until)
+        return lo, hi
+
+    def _sort(self) -> None:
+        order = sorted(range(len(self.ts)), key=self.ts.__getitem__)
+        self.ts = array("d", (self.ts[i] for i in order))
+        self.revenue = array("d", (self.revenue[i] for i in order))
+        for column in self.COLUMNS:
+            ids = self.ids[column]
+            self.ids[column] = array("I", (ids[i] for i in order))
+        self._sorted = True
+
+
+class PendingOrderStore(JsonlFile):
+    """Журнал переходов незавершённых заказов для восстановления после перезапуска"""
+
+    TERMINAL_STEPS = ("done", "failed", "expired")
+
+    def __init__(self, path: str, compact_after: int = 1000, **options):
+        super().__init__(path, **options)
+        self.compact_after = compact_after
+        self._state_lock = threading.Lock()
+        self._live: dict[int, dict] = {}
+        self._writes = 0
+
+    @classmethod
+    def from_config(cls, path: str, config: dict) -> PendingOrderStore:
+        options = config.get("journal", {})
+        return cls(
+            path,
+            fsync=options.get("fsync", "interval"),
+            fsync_interval=options.get("fsync_interval", 1.0),
+        )
+
+    def load(self) -> list[dict]:
+        live: dict[int, dict] = {}
+        for record in self.iter_records():
+            order_id = record.get("order_id")
+            if record.get("step") in self.TERMINAL_STEPS:
+                live.pop(order_id, None)
+            else:
+                live.setdefault(order_id, {}).update(record)
+
+        with self._state_lock:
+            self._live = live
+            self._compact()
+            return [dict(data) for data in live.values()]
+
+    def record(self, order_id: int, **fields) -> None:
+        entry = {"order_id": order_id, **fields}
+        with self._state_lock:
+            if fields.get("step") in self.TERMINAL_STEPS:
+                self._live.pop(order_id, None)
+            else:
+                self._live.setdefault(order_id, {}).update(entry)
+            self.append(entry)
+            self._writes += 1
+            if self._writes > max(self.compact_after, 4 * len(self._live)):
+                self._compact()
+
+    def _compact(self) -> None:
+        self.rewrite(list(self._live.values()))
+        self._writes = len(self._live)
+
+
+class DispatchLedger(JsonlFile):
+    """Журнал отправок: каждый гифт заказа уходит к провайдеру не больше одного раза"""
+
+    IN_FLIGHT = "in_flight"
+    SENT = "sent"
+    FAILED = "failed"
+    UNKNOWN = "unknown"
+    # Повторная отправка в этих состояниях возможна только после сверки
+    BLOCKING = (IN_FLIGHT, SENT, UNKNOWN)
+
+    def __init__(self, path: str, retention: float = 30 * 86400, compact_after: int = 1000, **options):
+        super().__init__(path, **options)
+        self.retention = retention
+        self.compact_after = compact_after
+        self._state_lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+        self._orders: dict[str, set[str]] = {}
+        self._writes = 0
+
+    @classmethod
+    def from_config(cls, path: str, config: dict) -> DispatchLedger:
+        # fsync на каждую запись: потеря отметки in_flight означает риск двойной отправки
+        return cls(path, retention=config.get("ledger_retention_days", 30) * 86400, fsync="always")
+
+    @staticmethod
+    def key(order_id, unit: int = 0) -> str:
+        return f"fp-{order_id}-{unit}"
+
+    @staticmethod
+    def order_of(key: str) -> str:
+        return key[3:].rsplit("-", 1)[0]
+
+    def load(self) -> None:
+        entries: dict[str, dict] = {}
+        for record in self.iter_records():
+            entries.setdefault(record["key"], {}).update(record)
+
+        # Отправка, прерванная перезапуском, могла дойти до провайдера
+        expire_before = time.time() - self.retention
+        interrupted = 0
+        for key, entry in list(entries.items()):
+            if entry["state"] == self.IN_FLIGHT:
+                entry["state"] = self.UNKNOWN
+                interrupted += 1
+            elif entry["state"] in (self.SENT, self.FAILED) and entry.get("ts", 0) < expire_before:
+                del entries[key]
+
+        with self._state_lock:
+            self._entries = entries
+            self._orders = {}
+            for key, entry in entries.items():
+                self._orders.setdefault(str(entry["order_id"]), set()).add(key)
+            self._compact()
+
+        if interrupted:
+            logger.warning("[SteamGifts] %s gifts were in flight during shutdown, marked for reconciliation", interrupted)
+
+    def get(self, key: str) -> dict | None:
+        return self._entries.get(key)
+
+    def state(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        return entry["state"] if entry else None
+
+    def begin(self, key: str) -> bool:
+        order_id = self.order_of(key)
+        with self._state_lock:
+            if self.state(key) in self.BLOCKING:
+                return False
+            self._write({"key": key, "order_id": order_id, "state": self.IN_FLIGHT, "ts": time.time()})
+            self._orders.setdefault(order_id, set()).add(key)
+            return True
+
+    def finish(self, key: str, state: str, **fields) -> None:
+        with self._state_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self._write({**entry, **{k: v for k, v in fields.items() if v is not None}, "state": state, "ts": time.time()})
+
+    def annotate(self, key: str, **fields) -> None:
+        with self._state_lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._write({**entry, **fields})
+
+    def entries(self) -> list[dict]:
+        with self._state_lock:
+            return list(self._entries.values())
+
+    def order_entries(self, order_id) -> list[dict]:
+        with self._state_lock:
+            keys = sorted(self._orders.get(str(order_id), ()))
+            return [self._entries[key] for key in keys if key in self._entries]
+
+    def open_units(self, order_id, quantity: int) -> list[int]:
+        return [unit for unit in range(quantity) if self.state(self.key(order_id, unit)) not in self.BLOCKING]
+
+    def states(self, order_id) -> Counter:
+        keys = self._orders.get(str(order_id), ())
+        return Counter(self._entries[key]["state"] for key in keys if key in self._entries)
+
+    def in_doubt(self, order_id) -> bool:
+        states = self.states(order_id)
+        return bool(states[self.UNKNOWN] or states[self.IN_FLIGHT])
+
+    def has_order(self, order_id) -> bool:
+        return any(state in self.BLOCKING for state in self.states(order_id))
+
+    def resolve(self, order_id, state: str) -> int:
+        resolved = 0
+        for key in list(self._orders.get(str(order_id), ())):
+            if self.state(key) in (self.UNKNOWN, self.IN_FLIGHT):
+                self.finish(key, state, reconciled=True)
+                resolved += 1
+        return resolved
+
+    def _write(self, entry: dict) -> None:
+        self._entries[entry["key"]] = entry
+        self.append(entry)
+        self._writes += 1
+        if self._writes > max(self.compact_after, 4 * len(self._entries)):
+            self._compact()
+
+    def _compact(self) -> None:
+        self.rewrite(list(self._entries.values()))
+        self._writes = len(self._entries)
+
+
+class ProviderStatusTracker:
+    """Отслеживание статусов заказов у провайдера пакетными запросами с растущими интервалами"""
+
+    SUCCESS = ("completed", "complete", "success", "delivered", "done")
+    FAILURE = ("failed", "error", "canceled", "cancelled", "refunded", "rejected")
+    # Промежуточные статусы, о которых покупателю не сообщаем
+    SILENT = ("", "created", "new", "pending", "queued", "processing")
+    LABELS = {
+        "completed": "доставлен",
+        "delivered": "доставлен",
+        "success": "доставлен",
+        "done": "доставлен",
+        "waiting_friend": "ожидает принятия заявки в друзья",
+        "friend_request": "ожидает принятия заявки в друзья",
+        "failed": "ошибка доставки",
+        "error": "ошибка доставки",
+        "canceled": "отменён",
+        "cancelled": "отменён",
+        "refunded": "возвращён",
+        "rejected": "отклонён",
+    }
+
+    def __init__(
+        self,
+        poll,
+        on_change,
+        batch_size: int = 50,
+        initial_interval: float = 60,
+        max_interval: float = 3600,
+        max_age: float = 7 * 86400,
+    ):
+        self.poll = poll
+        self.on_change = on_change
+        self.batch_size = max(1, int(batch_size))
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.max_age = max_age
+        self._entries: dict[str, dict] = {}
+        self._heap: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, poll, on_change, config: dict) -> ProviderStatusTracker:
+        return cls(
+            poll,
+            on_change,
+            batch_size=config.get("batch_size", 50),
+            initial_interval=config.get("initial_interval", 60),
+            max_interval=config.get("max_interval", 3600),
+            max_age=config.get("max_age", 7 * 86400),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @classmethod
+    def is_final(cls, status: str) -> bool:
+        return status in cls.SUCCESS or status in cls.FAILURE
+
+    def track(self, provider_id, status: str = "", created: float | None = None, **info) -> None:
+        provider_id = str(provider_id)
+        if self.is_final(status):
+            return
+        now = time.time()
+        entry = {
+            **info,
+            "provider_id": provider_id,
+            "status": status,
+            "created": created or now,
+            "interval": self.initial_interval,
+            "next_poll": now + self.initial_interval,
+        }
+        with self._lock:
+            self._entries[provider_id] = entry
+            heapq.heappush(self._heap, (entry["next_poll"], provider_id))
+
+    def poll_due(self) -> int:
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                next_poll, provider_id = heapq.heappop(self._heap)
+                entry = self._entries.get(provider_id)
+                # В куче могут остаться устаревшие записи после перепланирования
+                if entry is None or entry["next_poll"] != next_poll:
+                    continue
+                if now - entry["created"] > self.max_age:
+                    del self._entries[provider_id]
+                    logger.warning("[SteamGifts] Stopped tracking provider order %s: too old", provider_id)
+                    continue
+                due.append(entry)
+
+        requests_made = 0
+        for start in range(0, len(due), self.batch_size):
+            batch = due[start : start + self.batch_size]
+            requests_made += 1
+            try:
+                statuses = self.poll([entry["provider_id"] for entry in batch])
+            except Exception as exc:
+                logger.warning("[SteamGifts] Provider status poll failed: %s", exc)
+                statuses = {}
+            for entry in batch:
+                self._update(entry, statuses.get(entry["provider_id"]))
+        return requests_made
+
+    def _update(self, entry: dict, status: str | None) -> None:
+        old = entry["status"]
+        changed = status is not None and status != old
+        if changed:
+            entry["status"] = status
+            try:
+                self.on_change(entry, old, status)
+            except Exception as exc:
+                logger.error("[SteamGifts] Status change handler error: %s", exc)
+
+        with self._lock:
+            if changed and self.is_final(status):
+                self._entries.pop(entry["provider_id"], None)
+                return
+            # Без изменений интервал удваивается, после изменения начинается сначала
+            entry["interval"] = self.initial_interval if changed else min(self.max_interval, entry["interval"] * 2)
+            entry["next_poll"] = time.time() + entry["interval"]
+            heapq.heappush(self._heap, (entry["next_poll"], entry["provider_id"]))
+
+
+class LotRecord:
+    """Настройки одного лота FunPay"""
+
+    __slots__ = ("lot_id", "name", "region", "sub_id", "min_price", "max_price", "cost", "enabled")
+
+    def __init__(
+        self,
+        lot_id: str,
+        name: str,
+        region: str = "ru",
+        sub_id: int = 0,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        cost: float | None = None,
+        enabled: bool = True,
+    ):
+        self.lot_id = str(lot_id)
+        self.name = name
+        self.region = region
+        self.sub_id = sub_id
+        self.min_price = min_price
+        self.max_price = max_price
+        self.cost = cost
+        self.enabled = enabled
+
+    @classmethod
+    def from_config(cls, lot_id: str, raw: str | dict) -> LotRecord:
+        name = raw if isinstance(raw, str) else raw.get("name")
+        if not name:
+            raise ValueError(f"не указано название игры у лота {lot_id}")
+        if isinstance(raw, str):
+            return cls(lot_id, raw)
+
+        def number(key: str) -> float | None:
+            return float(raw[key]) if raw.get(key) is not None else None
+
+        return cls(
+            lot_id,
+            name,
+            region=raw.get("region", "ru"),
+            sub_id=int(raw.get("sub_id", 0)),
+            min_price=number("min_price"),
+            max_price=number("max_price"),
+            cost=number("cost"),
+            enabled=bool(raw.get("enabled", True)),
+        )
+
+    def to_config(self) -> dict:
+        data = {"name": self.name, "region": self.region}
+        if self.sub_id:
+            data["sub_id"] = self.sub_id
+        for key in ("min_price", "max_price", "cost"):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        if not self.enabled:
+            data["enabled"] = False
+        return data
+
+    def validate(self) -> None:
+        if not self.lot_id.isdigit():
+            raise ValueError(f"ID лота должен быть числом: {self.lot_id}")
+        if not self.name or not self.name.strip():
+            raise ValueError(f"пустое название игры у лота {self.lot_id}")
+        if self.region not in REGIONS:
+            raise ValueError(f"неизвестный регион {self.region} у лота {self.lot_id}")
+
+    def accepts_price(self, price: float) -> bool:
+        if self.min_price is not None and price < self.min_price:
+            return False
+        if self.max_price is not None and price > self.max_price:
+            return False
+        return True
+
+
+class LotCatalog:
+    """Индекс лотов по lot_id, построенный из lot_game_mapping"""
+
+    def __init__(self, mapping: dict):
+        self.mapping = mapping
+        self.version = 0
+        self._index: dict[str, LotRecord] = {}
+        self._search_cache = TTLCache(maxsize=128, ttl=600)
+        self.rebuild()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(list(self._index.values()))
+
+    def __contains__(self, lot_id) -> bool:
+        return str(lot_id) in self._index
+
+    def rebuild(self) -> None:
+        index = {}
+        for lot_id, raw in self.mapping.items():
+            try:
+                index[str(lot_id)] = LotRecord.from_config(lot_id, raw)
+            except (TypeError, ValueError) as exc:
+                logger.error("[SteamGifts] Invalid lot %s in config: %s", lot_id, exc)
+        self._index = index
+        self._changed()
+
+    def get(self, lot_id) -> LotRecord | None:
+        return self._index.get(str(lot_id))
+
+    def add(self, record: LotRecord) -> None:
+        self.mapping[record.lot_id] = record.to_config()
+        self._index[record.lot_id] = record
+        self._changed()
+
+    def add_many(self, records: list[LotRecord]) -> None:
+        for record in records:
+            self.mapping[record.lot_id] = record.to_config()
+            self._index[record.lot_id] = record
+        self._changed()
+
+    def remove(self, lot_id) -> LotRecord | None:
+        record = self._index.pop(str(lot_id), None)
+        if record is not None:
+            self.mapping.pop(record.lot_id, None)
+            self._changed()
+        return record
+
+    CSV_FIELDS = ("lot_id", "name", "region", "sub_id", "min_price", "max_price", "cost", "enabled")
+
+    def export_json(self, records: list[LotRecord] | None = None) -> bytes:
+        records = self._index.values() if records is None else records
+        data = {record.lot_id: record.to_config() for record in records}
+        return json.dumps(data, indent=4, ensure_ascii=False).encode("utf-8")
+
+    def export_csv(self) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=self.CSV_FIELDS)
+        writer.writeheader()
+        for record in self._index.values():
+            writer.writerow({"lot_id": record.lot_id, **record.to_config(), "enabled": int(record.enabled)})
+        return buffer.getvalue().encode("utf-8-sig")
+
+    @staticmethod
+    def parse_import(filename: str, raw: bytes) -> tuple[list[LotRecord], list[str]]:
+        text = raw.decode("utf-8-sig")
+        if filename.lower().endswith(".csv"):
+            rows = [
+                (row.get("lot_id", ""), {k: v for k, v in row.items() if k == "name" or v not in ("", None)})
+                for row in csv.DictReader(io.StringIO(text))
+            ]
+            for _, row in rows:
+                if "enabled" in row:
+                    row["enabled"] = row["enabled"].strip().lower() not in ("0", "false", "no", "нет")
+        else:
+            data = json.loads(text)
+            if isinstance(data, dict):
+                rows = list(data.items())
+            else:
+                rows = [(row.get("lot_id", ""), row) for row in data]
+
+        records, errors = [], []
+        for line, (lot_id, row) in enumerate(rows, 1):
+            try:
+                record = LotRecord.from_config(str(lot_id).strip(), row)
+                record.region = str(record.region).strip().lower()
+                record.validate()
+                records.append(record)
+            except (TypeError, ValueError, AttributeError) as exc:
+                errors.append(f"#{line}: {exc}")
+        return records, errors
+
+    def search(self, query: str = "", region: str = "") -> list[LotRecord]:
+        key = (query.casefold(), region)
+        result = self._search_cache.get(key)
+        if result is None:
+            result = [
+                lot
+                for lot in self._index.values()
+                if (not region or lot.region == region)
+                and (not key[0] or key[0] in lot.name.casefold() or lot.lot_id.startswith(key[0]))
+            ]
+            self._search_cache.set(key, result)
+        return result
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._search_cache.clear()
+
+
+class CompiledTemplate:
+    """Шаблон сообщения, разобранный один раз при загрузке конфига"""
+
+    __slots__ = ("source", "parts", "fields")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.parts: list = []
+        self.fields: set[str] = set()
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(source):
+            if literal:
+                self.parts.append(literal)
+            if field_name is None:
+                continue
+            if not field_name.isidentifier():
+                raise ValueError(f"неподдерживаемый плейсхолдер {{{field_name}}}")
+            self.fields.add(field_name)
+            self.parts.append((field_name, format_spec or "", conversion))
+
+    def render(self, values: dict) -> str:
+        if not self.fields:
+            return self.source
+
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            name, format_spec, conversion = part
+            if name not in values:
+                out.append(f"{{{name}}}")
+                continue
+            value = values[name]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "s":
+                value = str(value)
+            out.append(format(value, format_spec))
+        return "".join(out)
+
 
 @dataclass
 class ConfigStore:
@@ -168,19 +2645,25 @@ class ConfigStore:
     config_dir: str
     defaults: dict
     config: dict = field(default_factory=dict)
+    flush_delay: float = 0.0
+    template_fields: dict[str, set[str]] = field(default_factory=dict)
+    _templates: dict[str, dict[str, CompiledTemplate]] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False)
+    _dirty: bool = field(default=False, init=False, repr=False)
+    _job: ScheduledJob | None = field(default=None, init=False, repr=False)
 
     def load(self) -> dict:
         if not os.path.exists(self.config_dir):
             os.makedirs(self.config_dir)
 
         if not os.path.exists(self.config_path):
-            with open(self.config_path, "w", encoding="utf-8") as file:
-                json.dump(self.defaults, file, indent=4, ensure_ascii=False)
+            self._write(json.dumps(self.defaults, indent=4, ensure_ascii=False))
 
         with open(self.config_path, "r", encoding="utf-8") as file:
             self.config = json.load(file)
 
         self._merge_defaults()
+        self.compile_templates()
         return self.config
 
     def _merge_defaults(self) -> None:
@@ -191,59 +2674,221 @@ class ConfigStore:
             if key not in self.config.setdefault("templates", {}):
                 self.config["templates"][key] = value
 
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
     def save(self) -> None:
-        with open(self.config_path, "w", encoding="utf-8") as file:
-            json.dump(self.config, file, indent=4, ensure_ascii=False)
+        with self._lock:
+            self._dirty = True
+            if self.flush_delay <= 0:
+                self.flush()
+                return
+            if self._job is None:
+                self._job = scheduler.call_later(self.flush_delay, self.flush)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+                self._job = None
+            if not self._dirty:
+                return
 
-    def format_template(self, template_name: str, **kwargs) -> str:
-        template = self.config.get("templates", {}).get(template_name, "")
-        if not template:
-            template = self.defaults.get("templates", {}).get(template_name, "")
+            # Конфиг могут менять из другого потока во время сериализации
+            for _ in range(3):
+                try:
+                    data = json.dumps(self.config, indent=4, ensure_ascii=False)
+                    break
+                except RuntimeError:
+                    continue
+            else:
+                logger.error("[SteamGifts] Config changed during save, retrying later")
+                return
+
+            self._write(data)
+            self._dirty = False
+
+    def close(self) -> None:
+        self.flush()
+
+    def _write(self, data: str) -> None:
+        tmp_path = f"{self.config_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.config_path)
+
+    def compile_templates(self) -> list[str]:
+        errors = []
+        defaults = self.defaults.get("templates", {})
+        sets = {"": self.config.get("templates", {}), **self.config.get("templates_i18n", {})}
+        compiled: dict[str, dict[str, CompiledTemplate]] = {}
+
+        for lang, templates in sets.items():
+            compiled[lang] = {}
+            for name, source in templates.items():
+                # Пустой шаблон не заменяет текст по умолчанию
+                template = self._compile(name, source, lang, errors) if source else None
+                if template is None and not lang and name in defaults:
+                    template = CompiledTemplate(defaults[name])
+                if template is not None:
+                    compiled[lang][name] = template
+
+        for message in errors:
+            logger.error("[SteamGifts] Template error: %s", message)
+        self._templates = compiled
+        return errors
+
+    def _compile(self, name: str, source: str, lang: str, errors: list[str]) -> CompiledTemplate | None:
+        where = f"{lang}/{name}" if lang else name
         try:
-            return template.format(**kwargs)
-        except KeyError:
-            return template
+            template = CompiledTemplate(source)
+        except ValueError as exc:
+            errors.append(f"{where}: {exc}")
+            return None
+
+        allowed = self.template_fields.get(name)
+        unknown = template.fields - allowed if allowed is not None else set()
+        if unknown:
+            errors.append(f"{where}: неизвестные плейсхолдеры {', '.join(sorted(unknown))}")
+            return None
+        return template
+
+    def set_template(self, template_name: str, source: str, lang: str = "") -> list[str]:
+        errors: list[str] = []
+        if self._compile(template_name, source, lang, errors) is None:
+            return errors
+        if lang:
+            self.config.setdefault("templates_i18n", {}).setdefault(lang, {})[template_name] = source
+        else:
+            self.config.setdefault("templates", {})[template_name] = source
+        self.compile_templates()
+        self.save()
+        return []
+
+    def format_template(self, template_name: str, lang: str | None = None, **kwargs) -> str:
+        lang = lang or self.config.get("language", "")
+        template = self._templates.get(lang, {}).get(template_name) or self._templates.get("", {}).get(template_name)
+        if template is None:
+            return self.defaults.get("templates", {}).get(template_name, "")
+        return template.render(kwargs)
 
 
 class SteamGiftPlugin:
-    def __init__(self) -> None:
+    def __init__(self, storage_dir: str = CONFIG_DIR) -> None:
+        self.storage_dir = storage_dir
         self.bot = None
         self.cardinal: Cardinal | None = None
-        self.config_store = ConfigStore(CONFIG_PATH, CONFIG_DIR, DEFAULT_CONFIG)
+        self.config_store = ConfigStore(
+            self.storage_path(CONFIG_PATH), storage_dir, DEFAULT_CONFIG, template_fields=TEMPLATE_FIELDS
+        )
         self.api_client: NSGiftsAPIClient | None = None
-        self.waiting_for_link: dict[int, dict] = {}
-        self.order_history: list[dict] = []
+        self.balance: BalanceCache | None = None
+        self.transport: HTTPTransport | None = None
+        self.dispatcher: GiftDispatcher | None = None
+        self.conversations = ConversationStore()
+        self.link_parser = SteamLinkParser()
+        self.lots = LotCatalog({})
+        self.pending: PendingOrderStore | None = None
+        self.journal: OrderJournal | None = None
+        self.ledger: DispatchLedger | None = None
+        self.order_fetcher: OrderFetcher | None = None
+        self.outbox: ChatOutbox | None = None
+        self.status_tracker: ProviderStatusTracker | None = None
+        self.stats = OrderStats(ConfigStore(self.storage_path(STATS_PATH), storage_dir, OrderStats.empty()))
+        self.analytics = OrderAnalytics()
         self._temp_auth_data: dict[int, dict] = {}
         self._temp_lot_data: dict[str, str] = {}
+        self._lot_filters: dict[int, dict] = {}
+        self._lot_pages: dict[tuple, tuple[str, K]] = {}
+        self._lot_proposals: dict[int, list[LotRecord]] = {}
+        self._metrics_server: ThreadingHTTPServer | None = None
+        self._jobs: list[ScheduledJob] = []
 
         self.cb_auth = "sg_auth"
         self.cb_stats = "sg_stats"
+        self.cb_analytics = "sg_analytics"
+        self.cb_metrics = "sg_metrics"
+        self.cb_hourly = "sg_hourly"
         self.cb_lots = "sg_lots"
         self.cb_add_lot = "sg_addlot"
         self.cb_del_lot = "sg_dellot_"
+        self.cb_lot_page = "sg_lotpage_"
+        self.cb_lot_search = "sg_lotsearch"
+        self.cb_lot_region = "sg_lotregion"
+        self.cb_lot_reset = "sg_lotreset"
+        self.cb_lot_export = "sg_lotexport_"
+        self.cb_lot_import = "sg_lotimport"
+        self.cb_lot_scan = "sg_lotscan"
+        self.cb_lot_scan_apply = "sg_lotscanapply"
+        self.cb_lot_scan_export = "sg_lotscanexport"
         self.cb_balance = "sg_balance"
+        self.cb_templates = "sg_templates"
+        self.cb_template = "sg_tpl_"
         self.cb_toggle_refunds = "sg_refunds"
         self.cb_back = "sg_back"
+        self.cb_reconcile = "sg_reconcile"
+        self.cb_rc_done = "sg_rcdone_"
+        self.cb_rc_resend = "sg_rcsend_"
+        self.cb_rc_refund = "sg_rcrefund_"
 
     @property
     def config(self) -> dict:
         return self.config_store.config
 
+    def storage_path(self, path: str) -> str:
+        # Пути файлов заданы относительно CONFIG_DIR, плагин может работать с другим каталогом
+        return os.path.join(self.storage_dir, os.path.relpath(path, CONFIG_DIR))
+
     def init(self, c: Cardinal) -> None:
         self.cardinal = c
         self.bot = c.telegram.bot
         self.config_store.load()
-        self.order_history = self.config.get("order_history", [])
+        self.config_store.flush_delay = self.config.get("config_flush_delay", 1.0)
+        self.lots = LotCatalog(self.config.setdefault("lot_game_mapping", {}))
+        self.journal = OrderJournal.from_config(self.storage_path(JOURNAL_PATH), self.config)
+        self.migrate_order_history()
+        self.stats.store.flush_delay = self.config_store.flush_delay
+        self.stats.load(self.journal)
+        self.analytics.load(self.journal.iter_records())
+        self.pending = PendingOrderStore.from_config(self.storage_path(PENDING_PATH), self.config)
+        self.conversations.persistence = self.pending
+        self.ledger = DispatchLedger.from_config(self.storage_path(LEDGER_PATH), self.config)
+        self.ledger.load()
 
         c.add_telegram_commands(
             UUID,
             [("gift_steam", "Steam Gifts панель", True)],
         )
 
+        self.transport = HTTPTransport.from_config(self.config)
+        self.link_parser = SteamLinkParser(
+            SteamVanityResolver(self.config["steam_api_key"]) if self.config.get("steam_api_key") else None,
+            TTLCache(maxsize=4096, ttl=self.config.get("vanity_cache_ttl", 86400)),
+        )
+        self.outbox = ChatOutbox.from_config(
+            lambda chat_id, text: self.cardinal.account.send_message(chat_id, text), self.config
+        )
+        self.outbox.start()
+        self.order_fetcher = OrderFetcher.from_config(
+            lambda order_id: self.cardinal.account.get_order(order_id),
+            self.config,
+            on_error=self.on_order_fetch_failed,
+        )
+        self.dispatcher = GiftDispatcher(self.config.get("dispatch_workers", 4))
+        self.dispatcher.start()
+        self.restore_pending_orders()
+        self.start_metrics()
+        self.start_drain()
+        self.start_sweeps()
+        self.start_status_tracking()
+
         api_login = self.config.get("api_login")
         api_password = self.config.get("api_password")
         if api_login and api_password:
-            self.api_client = NSGiftsAPIClient(TokenManager(api_login, api_password))
+            self.setup_api_client(api_login, api_password)
             logger.info("[SteamGifts] API client initialized")
         else:
             logger.warning("[SteamGifts] Авторизация не настроена")
@@ -257,86 +2902,231 @@ class SteamGiftPlugin:
         logger.info("[SteamGifts] Plugin v%s initialized!", VERSION)
 
     def shutdown(self) -> None:
+        for job in self._jobs:
+            job.cancel()
+        self._jobs.clear()
+        if self.order_fetcher:
+            self.order_fetcher.close()
+        if self.dispatcher:
+            self.dispatcher.stop()
+
+        if self.outbox:
+            self.outbox.stop()
+
+        self.stop_metrics()
+
         try:
-            self.config["order_history"] = self.order_history
-            self.config_store.save()
-            logger.info("[SteamGifts] Config saved. Orders: %s", len(self.order_history))
+            self.config_store.close()
+            self.stats.store.close()
+            if self.journal:
+                self.journal.close()
+            logger.info("[SteamGifts] Config saved. Orders: %s", self.stats.total_orders)
         except Exception as exc:
             logger.error("[SteamGifts] Save error: %s", exc)
 
-        if self.waiting_for_link:
-            logger.warning("[SteamGifts] %s orders still waiting", len(self.waiting_for_link))
-            self.waiting_for_link.clear()
+        if self.pending:
+            self.pending.close()
 
+        if self.ledger:
+            self.ledger.close()
+
+        if self.conversations:
+            logger.warning("[SteamGifts] %s orders still waiting, they will be restored", len(self.conversations))
+            self.conversations.clear()
+
+        if self.transport:
+            self.transport.close()
+
+        scheduler.stop()
         logger.info("[SteamGifts] Plugin v%s stopped", VERSION)
 
-    def is_valid_link(self, link: str) -> tuple[bool, str]:
-        pattern = r"https?://steamcommunity\.com/(id|profiles)/[A-Za-z0-9_-]+"
-        if re.match(pattern, link):
-            return True, ""
-        return False, self.config_store.format_template("invalid_link")
+    def start_metrics(self) -> None:
+        metrics.gauge("steamgifts_dispatch_pending", lambda: self.dispatcher.pending)
+        metrics.gauge("steamgifts_open_orders", lambda: len(self.conversations))
+        metrics.gauge("steamgifts_balance", lambda: self.balance.value if self.balance else None)
+        metrics.gauge("steamgifts_ratelimit_waiting", lambda: self.transport.limiter.waiting)
+        metrics.gauge("steamgifts_ratelimit_rate", lambda: self.transport.limiter.current_rate)
+        metrics.gauge("steamgifts_outbox_pending", lambda: self.outbox.pending)
+        metrics.gauge("steamgifts_tracked_provider_orders", lambda: len(self.status_tracker) if self.status_tracker else 0)
+        metrics.gauge("steamgifts_parked_orders", lambda: self.conversations.parked_count)
+        metrics.gauge(
+            "steamgifts_provider_available",
+            lambda: self.transport.breaker.state == CircuitBreaker.CLOSED,
+        )
+
+        port = int(self.config.get("metrics_port") or 0)
+        if port:
+            try:
+                self._metrics_server = metrics.serve(port)
+                logger.info("[SteamGifts] Metrics: http://127.0.0.1:%s/metrics", port)
+            except OSError as exc:
+                logger.error("[SteamGifts] Metrics server error: %s", exc)
+
+        if self.config.get("metrics_file"):
+            interval = max(1.0, float(self.config.get("metrics_interval", 15)))
+            self._jobs.append(scheduler.call_every(interval, self.write_metrics_file))
+
+    def write_metrics_file(self) -> None:
+        try:
+            metrics.write_file(self.storage_path(METRICS_PATH))
+        except OSError as exc:
+            logger.error("[SteamGifts] Metrics file error: %s", exc)
+
+    def stop_metrics(self) -> None:
+        if self.config.get("metrics_file"):
+            self.write_metrics_file()
+        if self._metrics_server:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+
+    def migrate_order_history(self) -> None:
+        if "order_history" not in self.config:
+            return
+
+        history = self.config.pop("order_history") or []
+        migrated = self.journal.migrate(history)
+        self.config_store.save()
+        logger.info("[SteamGifts] Migrated %s orders from config.json to %s", migrated, self.journal.path)
+
+    def restore_pending_orders(self) -> None:
+        reconcile = []
+        for data in sorted(self.pending.load(), key=lambda data: data.get("step_at", 0)):
+            interrupted = data.get("step") == "dispatching"
+            self.conversations.add(data, persist=False)
+            if interrupted:
+                self.conversations.update(data["order_id"], step="reconcile")
+            if data["step"] == "reconcile":
+                reconcile.append(data)
+
+        if self.conversations:
+            logger.info("[SteamGifts] Restored %s pending orders", len(self.conversations))
+
+        if reconcile:
+            logger.warning("[SteamGifts] %s orders were interrupted during gift sending", len(reconcile))
+            self.notify_owner(
+                "⚠️ <b>Steam Gifts</b>\n\n"
+                f"Заказов, прерванных во время отправки гифта: {len(reconcile)}\n"
+                "Проверьте их в ns.gifts и отметьте в панели /gift_steam → ⚠️ Сверка"
+            )
+
+    def notify_owner(self, text: str) -> None:
+        if not self.bot or not self.cardinal:
+            return
+        for user_id in getattr(self.cardinal.telegram, "authorized_users", []):
+            try:
+                self.bot.send_message(user_id, text, parse_mode="HTML")
+            except Exception as exc:
+                logger.error("[SteamGifts] Notify error for %s: %s", user_id, exc)
+
+    def setup_api_client(self, api_login: str, api_password: str) -> NSGiftsAPIClient:
+        if self.transport is None:
+            self.transport = HTTPTransport.from_config(self.config)
+        if self.transport.breaker:
+            self.transport.breaker.on_change = self.on_breaker_change
+        token_manager = TokenManager(
+            api_login,
+            api_password,
+            self.transport,
+            refresh_margin=self.config.get("token_refresh_margin", 300),
+            cache_path=self.storage_path(TOKEN_PATH) if self.config.get("token_cache", True) else None,
+        )
+        self.api_client = NSGiftsAPIClient(token_manager, ledger=self.ledger)
+        self.balance = BalanceCache(
+            self.api_client.get_balance,
+            ttl=self.config.get("balance_ttl", 300),
+            low_threshold=self.config.get("low_balance_threshold", 0),
+            on_low=self.notify_low_balance,
+        )
+        return self.api_client
 
-    def get_game_by_lot(self, lot_id: str) -> tuple[str | None, str | None]:
-        lot_data = self.config.get("lot_game_mapping", {}).get(str(lot_id))
-        if not lot_data:
-            return None, None
-        if isinstance(lot_data, str):
-            return lot_data, "ru"
-        return lot_data.get("name"), lot_data.get("region", "ru")
+    def notify_low_balance(self, balance: float) -> None:
+        logger.warning("[SteamGifts] Low ns.gifts balance: %.2f", balance)
+        self.notify_owner(f"⚠️ <b>Steam Gifts</b>\n\nНизкий баланс ns.gifts: {balance:.2f} руб.")
 
     def handle_new_order(self, c: Cardinal, event: NewOrderEvent) -> None:
         order_id = event.order.id
         order = event.order
 
-        logger.info("[SteamGifts] New order: %s", order_id)
-
-        game_name, region = self.get_game_by_lot(str(order.lot_id))
-
-        if not game_name:
+        lot = self.lots.get(order.lot_id)
+        if lot is None or not lot.enabled:
             logger.debug("[SteamGifts] Lot %s not configured", order.lot_id)
             return
 
-        try:
-            full_order = c.account.get_order(order_id)
-        except Exception as exc:
-            logger.error("[SteamGifts] Get order error: %s", exc)
+        if order_id in self.conversations or (self.ledger and self.ledger.has_order(order_id)):
+            logger.info("[SteamGifts] Order %s is already being handled, duplicate event ignored", order_id)
             return
 
-        if hasattr(full_order, "chat_id"):
-            chat_id = full_order.chat_id
-        elif hasattr(full_order, "chat") and hasattr(full_order.chat, "id"):
-            chat_id = full_order.chat.id
-        else:
-            logger.error("[SteamGifts] No chat_id for order %s", order_id)
-            return
+        logger.info("[SteamGifts] New order: %s", order_id)
 
-        buyer_id = getattr(full_order, "buyer_id", None)
+        if not self.order_fetcher.submit(order_id, self.start_order, c, lot, time.perf_counter()):
+            logger.info("[SteamGifts] Order %s is already being fetched", order_id)
 
-        if buyer_id is None:
-            logger.error("[SteamGifts] No buyer_id for order %s", order_id)
+    def start_order(self, c: Cardinal, lot: LotRecord, received_at: float, info: OrderInfo) -> None:
+        order_id = info.order_id
+        revenue = info.revenue
+        quantity = info.quantity
+        chat_id = info.chat_id
+        buyer_id = info.buyer_id
+
+        if order_id in self.conversations:
             return
 
-        try:
-            revenue = full_order.sum
-        except AttributeError:
-            logger.error("[SteamGifts] No sum for order %s", order_id)
+        if not lot.accepts_price(revenue / quantity):
+            logger.warning("[SteamGifts] Order %s price %s is outside lot %s limits", order_id, revenue, lot.lot_id)
+            self.notify_owner(
+                "⚠️ <b>Steam Gifts</b>\n\n"
+                f"Заказ <code>#{order_id}</code> на сумму {revenue} вне ценовых границ лота "
+                f"<code>{lot.lot_id}</code> ({lot.name}). Обработайте его вручную."
+            )
             return
 
-        self.waiting_for_link[order_id] = {
-            "buyer_id": buyer_id,
-            "step": "await_link",
-            "chat_id": chat_id,
-            "game_name": game_name,
-            "region": region,
-            "order_id": order_id,
-            "revenue": revenue,
-        }
+        self.conversations.add(
+            {
+                "buyer_id": buyer_id,
+                "step": "await_link",
+                "chat_id": chat_id,
+                "game_name": lot.name,
+                "region": lot.region,
+                "sub_id": lot.sub_id,
+                "order_id": order_id,
+                "revenue": revenue,
+                "lot_id": lot.lot_id,
+                "cost": lot.cost,
+                "quantity": quantity,
+                "step_at": time.time(),
+            }
+        )
+        metrics.inc("steamgifts_orders_total", result="started")
 
         message = self.config_store.format_template("start_message")
-        c.account.send_message(chat_id, message)
+        with metrics.timer("steamgifts_stage_seconds", stage="start_message"):
+            # Время до приветствия считается по факту отправки, а не постановки в очередь
+            self.send_chat(
+                chat_id,
+                message,
+                on_sent=lambda: metrics.observe(
+                    "steamgifts_stage_seconds", time.perf_counter() - received_at, stage="order_to_start_message"
+                ),
+            )
 
         logger.info("[SteamGifts] Waiting for Steam link from buyer %s", buyer_id)
 
+    def send_chat(self, chat_id: int, text: str, on_sent=None) -> None:
+        if self.outbox and self.outbox.running:
+            self.outbox.send(chat_id, text, on_sent)
+            return
+        self.cardinal.account.send_message(chat_id, text)
+        if on_sent:
+            on_sent()
+
+    def on_order_fetch_failed(self, order_id, exc: Exception) -> None:
+        self.notify_owner(
+            "⚠️ <b>Steam Gifts</b>\n\n"
+            f"Не удалось получить данные заказа <code>#{order_id}</code>: {exc}\n"
+            "Обработайте его вручную."
+        )
+
     def handle_new_message(self, c: Cardinal, event: NewMessageEvent) -> None:
         msg = event.message
         chat_id = getattr(msg, "chat_id", None)
@@ -346,51 +3136,90 @@ class SteamGiftPlugin:
         if text is None or chat_id is None or author_id is None:
             return
 
-        text = text.replace("\u2061", "").strip()
+        if not self.conversations.has_buyer(author_id):
+            return
 
-        for order_id, data in list(self.waiting_for_link.items()):
-            if data["buyer_id"] != author_id:
-                continue
+        data = self.conversations.resolve(author_id, chat_id)
+        if data is None:
+            return
 
-            if data["step"] == "await_link":
-                link_match = re.search(r"https?://[^\s]+", text)
+        text = text.replace("\u2061", "").strip()
+        order_id = data["order_id"]
 
-                if not link_match:
-                    c.account.send_message(chat_id, self.config_store.format_template("invalid_link"))
-                    return
+        if data["step"] == "await_link":
+            steam_link = self.link_parser.parse(text)
+            if steam_link is None:
+                self.send_chat(chat_id, self.config_store.format_template("invalid_link"))
+                return
 
-                link = link_match.group(0)
-                ok, reason = self.is_valid_link(link)
+            if self.link_parser.needs_lookup(steam_link):
+                # Запрос к Steam Web API выполняется в пуле отправки, а не в потоке событий Cardinal
+                if not self.dispatcher.submit(order_id, self.accept_link, data, steam_link):
+                    logger.warning("[SteamGifts] Order %s is already resolving a link", order_id)
+                return
 
-                if not ok:
-                    c.account.send_message(chat_id, reason)
-                    return
+            self.accept_link(data, steam_link)
+            return
 
-                data["link"] = link
-                data["step"] = "await_confirm"
+        if data["step"] == "dispatching":
+            self.send_chat(chat_id, "⏳ Заказ уже обрабатывается, ожидайте")
+            return
 
-                c.account.send_message(
-                    chat_id,
-                    self.config_store.format_template("link_confirmation", link=link),
-                )
-                return
+        if data["step"] == "reconcile":
+            self.send_chat(chat_id, "⏳ Заказ проверяется продавцом, ожидайте")
+            return
 
-            if data["step"] == "await_confirm":
-                if text.lower() in ["+", "да", "yes", "confirm"]:
-                    self.process_purchase(c, data)
-                    return
+        if data["step"] == "parked":
+            self.send_chat(chat_id, self.config_store.format_template("provider_unavailable"))
+            return
 
-                if text.lower() in ["-", "нет", "no", "cancel"]:
-                    data["step"] = "await_link"
-                    c.account.send_message(chat_id, "Отправка отменена. Отправьте новую ссылку.")
+        if data["step"] == "await_confirm":
+            if text.lower() in ["+", "да", "yes", "confirm"]:
+                self.observe_wait(data)
+                if self.conversations.update(order_id, step="dispatching", step_at=time.time()) is None:
+                    # Заказ успел закрыться по бездействию
                     return
+                if not self.dispatcher.submit(order_id, self.process_purchase, c, data):
+                    logger.warning("[SteamGifts] Order %s is already dispatching", order_id)
+                return
 
-                c.account.send_message(chat_id, "Отправьте + для подтверждения или - для отмены")
+            if text.lower() in ["-", "нет", "no", "cancel"]:
+                self.observe_wait(data)
+                self.conversations.update(order_id, step="await_link", step_at=time.time())
+                self.send_chat(chat_id, "Отправка отменена. Отправьте новую ссылку.")
                 return
 
+            self.send_chat(chat_id, "Отправьте + для подтверждения или - для отмены")
+
+    def accept_link(self, data: dict, steam_link: SteamLink) -> None:
+        with metrics.timer("steamgifts_stage_seconds", stage="resolve_link"):
+            steam_link = self.link_parser.resolve(steam_link)
+
+        order_id = data["order_id"]
+        if self.conversations.get(order_id) is not data or data["step"] != "await_link":
+            # Пока ссылка проверялась, заказ закрыли или он перешёл дальше
+            return
+
+        if steam_link is None:
+            self.send_chat(data["chat_id"], self.config_store.format_template("invalid_link"))
+            return
+
+        link = steam_link.url
+        self.observe_wait(data)
+        self.conversations.update(order_id, link=link, step="await_confirm", step_at=time.time())
+        self.send_chat(
+            data["chat_id"],
+            self.config_store.format_template("link_confirmation", link=link),
+        )
+
+    def observe_wait(self, data: dict) -> None:
+        if data.get("step_at"):
+            metrics.observe("steamgifts_wait_seconds", max(0.0, time.time() - data["step_at"]), step=data["step"])
+
     def process_purchase(self, c: Cardinal, data: dict) -> None:
         if not self.api_client:
-            c.account.send_message(
+            self.conversations.update(data["order_id"], step="await_confirm")
+            self.send_chat(
                 data["chat_id"],
                 self.config_store.format_template("purchase_error", error="API клиент не настроен"),
             )
@@ -401,45 +3230,111 @@ class SteamGiftPlugin:
         game_name = data["game_name"]
         region = data["region"]
         order_id = data["order_id"]
-        buyer_id = data["buyer_id"]
-        revenue = data["revenue"]
-
-        c.account.send_message(chat_id, f"⏳ Отправляем {game_name}...")
+        quantity = data.get("quantity", 1)
+        units = self.ledger.open_units(order_id, quantity) if self.ledger else list(range(quantity))
+        cost = data["cost"] * len(units) if data.get("cost") is not None else None
+        step = "failed"
+        reserved = None
+        record = True
+        started = time.perf_counter()
 
         try:
-            result = self.api_client.send_gift(link, game_name, region)
+            if not units:
+                # Все гифты заказа уже отправлены или ждут сверки, повторно не отправляем
+                record = False
+                step = "reconcile" if self.ledger.in_doubt(order_id) else "done"
+                logger.warning("[SteamGifts] Order %s was already dispatched, skipping", order_id)
+                return
 
-            if result["success"]:
+            breaker = self.api_client.transport.breaker
+            if breaker and not breaker.available:
+                step = self.park_order(c, data)
+                return
+
+            if self.balance and not self.balance.reserve(cost):
+                self.send_chat(chat_id, self.config_store.format_template("insufficient_balance"))
+                self.try_refund(c, order_id, "Insufficient balance")
+                logger.error("[SteamGifts] ❌ Not enough balance for order %s", order_id)
+                return
+            reserved = cost
+
+            items = [
+                {
+                    "steam_link": link,
+                    "game_name": game_name,
+                    "region": region,
+                    "sub_id": data.get("sub_id", 0),
+                    "idempotency_key": DispatchLedger.key(order_id, unit),
+                }
+                for unit in units
+            ]
+            quantity = len(items)
+            if quantity > 1:
+                self.send_chat(chat_id, f"⏳ Отправляем {game_name} × {quantity}...")
+                results = self.api_client.send_gifts(items, self.config.get("batch_parallelism", 4))
+            else:
+                self.send_chat(chat_id, f"⏳ Отправляем {game_name}...")
+                results = [self.api_client.send_gift(**items[0])]
+
+            sent = sum(1 for result in results if result["success"])
+            errors = [result.get("error", "Unknown error") for result in results if not result["success"]]
+            self.track_provider_orders(data, items, results)
+
+            if self.balance and reserved is not None:
+                # Резерв неотправленных гифтов возвращается, с неизвестным исходом — остаётся списанным
+                unit_cost = data["cost"]
+                returned = sum(1 for result in results if not result["success"] and not result.get("unknown"))
+                self.balance.release(unit_cost * returned)
+                self.balance.commit(unit_cost * (len(results) - returned))
+                reserved = None
+
+            if sent:
+                step = "done"
+
+            if any(result.get("unknown") for result in results):
+                step = self.hold_for_reconcile(c, data, errors[0])
+                return
+
+            if errors and all(result.get("unavailable") for result in results if not result["success"]):
+                step = self.park_order(c, data)
+                return
+
+            if not errors:
                 success_message = self.config_store.format_template(
                     "purchase_success",
                     game_name=game_name,
                 )
-                c.account.send_message(chat_id, success_message)
-
-                self.order_history.append(
-                    {
-                        "order_id": order_id,
-                        "buyer_id": buyer_id,
-                        "game_name": game_name,
-                        "region": region,
-                        "link": link,
-                        "revenue": revenue,
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    }
-                )
-                self.config["order_history"] = self.order_history
-                self.config_store.save()
+                self.send_chat(chat_id, success_message)
+                logger.info("[SteamGifts] ✅ Gift sent: %s x%s to %s", game_name, quantity, link)
 
-                logger.info("[SteamGifts] ✅ Gift sent: %s to %s", game_name, link)
+            elif sent:
+                self.send_chat(
+                    chat_id,
+                    self.config_store.format_template(
+                        "purchase_partial",
+                        sent=sent,
+                        quantity=quantity,
+                        game_name=game_name,
+                        error=errors[0],
+                    ),
+                )
+                self.notify_owner(
+                    "⚠️ <b>Steam Gifts</b>\n\n"
+                    f"Заказ <code>#{order_id}</code>: отправлено {sent} из {quantity} гифтов \"{game_name}\"\n"
+                    f"Ошибка: {errors[0]}"
+                )
+                logger.error("[SteamGifts] ❌ Order %s partially sent (%s/%s): %s", order_id, sent, quantity, errors[0])
 
             else:
-                error_msg = result.get("error", "Unknown error")
+                error_msg = errors[0]
 
                 if "Insufficient" in error_msg or "balance" in error_msg.lower():
-                    c.account.send_message(chat_id, self.config_store.format_template("insufficient_balance"))
+                    if self.balance:
+                        self.balance.invalidate()
+                    self.send_chat(chat_id, self.config_store.format_template("insufficient_balance"))
                     self.try_refund(c, order_id, "Insufficient balance")
                 else:
-                    c.account.send_message(
+                    self.send_chat(
                         chat_id,
                         self.config_store.format_template("purchase_error", error=error_msg),
                     )
@@ -448,14 +3343,289 @@ class SteamGiftPlugin:
 
         except Exception as exc:
             error_msg = str(exc)
-            c.account.send_message(
+            if self.balance and reserved is not None:
+                self.balance.release(reserved)
+            metrics.inc("steamgifts_errors_total", cause="exception")
+            self.send_chat(
                 chat_id,
                 self.config_store.format_template("purchase_error", error=error_msg),
             )
             logger.error("[SteamGifts] Exception: %s", error_msg)
 
         finally:
-            self.waiting_for_link.pop(order_id, None)
+            metrics.observe("steamgifts_stage_seconds", time.perf_counter() - started, stage="purchase")
+            metrics.inc("steamgifts_orders_total", result=step)
+            if step in ("parked", "reconcile"):
+                self.conversations.update(order_id, step=step, step_at=time.time())
+            else:
+                if record:
+                    self.complete_order(data)
+                self.conversations.finish(order_id, step)
+
+    def hold_for_reconcile(self, c: Cardinal, data: dict, error: str) -> str:
+        # Провайдер мог принять заказ: повторная отправка только после сверки владельцем
+        order_id = data["order_id"]
+        self.send_chat(data["chat_id"], "⏳ Заказ проверяется продавцом, ожидайте")
+        self.notify_owner(
+            "⚠️ <b>Steam Gifts</b>\n\n"
+            f"Заказ <code>#{order_id}</code> ({data['game_name']}): исход отправки неизвестен\n"
+            f"Ошибка: {error}\n\n"
+            "Проверьте его в ns.gifts и отметьте в панели /gift_steam → ⚠️ Сверка"
+        )
+        logger.error("[SteamGifts] Order %s outcome unknown, held for reconciliation: %s", order_id, error)
+        return "reconcile"
+
+    def park_order(self, c: Cardinal, data: dict) -> str:
+        if not data.get("parked_at"):
+            self.conversations.update(data["order_id"], parked_at=time.time())
+            self.send_chat(data["chat_id"], self.config_store.format_template("provider_unavailable"))
+        logger.warning("[SteamGifts] NS.Gifts unavailable, order %s parked", data["order_id"])
+        return "parked"
+
+    def get_parked_orders(self) -> list[dict]:
+        return self.conversations.parked()
+
+    def drain_parked_orders(self) -> int:
+        # Отложенные заказы возвращаются в очередь отправки небольшими порциями;
+        # пока цепь не замкнута, первым идёт пробный запрос баланса.
+        parked = self.get_parked_orders()
+        if not parked or not self.api_client:
+            return 0
+
+        breaker = self.api_client.transport.breaker
+        if breaker and breaker.state != CircuitBreaker.CLOSED:
+            if not breaker.available:
+                return 0
+            try:
+                self.api_client.get_balance()
+            except Exception:
+                return 0
+
+        batch = parked[: max(1, int(self.config.get("circuit_breaker", {}).get("drain_batch", 5)))]
+        for data in batch:
+            self.conversations.update(data["order_id"], step="dispatching", step_at=time.time())
+            if not self.dispatcher.submit(data["order_id"], self.process_purchase, self.cardinal, data):
+                self.conversations.update(data["order_id"], step="parked")
+        logger.info("[SteamGifts] Resumed %s parked orders, %s left", len(batch), len(parked) - len(batch))
+        return len(batch)
+
+    def start_drain(self) -> None:
+        interval = max(0.5, float(self.config.get("circuit_breaker", {}).get("drain_interval", 2)))
+        self._jobs.append(scheduler.call_every(interval, self.drain_parked_orders))
+
+    def start_sweeps(self) -> None:
+        options = self.config.get("order_sweep", {})
+        interval = max(1.0, float(options.get("interval", 60)))
+        self._jobs.append(scheduler.call_every(interval, self.sweep_orders))
+
+    def sweep_orders(self) -> None:
+        # Берутся только заказы из головы очередей активности, стоимость не зависит от числа открытых заказов
+        options = self.config.get("order_sweep", {})
+        remind_after = float(options.get("remind_after", 1800))
+        expire_after = float(options.get("expire_after", 86400))
+        now = time.time()
+
+        for data in self.conversations.due_reminders(now - remind_after):
+            if remind_after <= 0:
+                continue
+            if data["step"] == "await_link":
+                text = self.config_store.format_template("reminder_link", game_name=data["game_name"])
+            else:
+                text = self.config_store.format_template(
+                    "reminder_confirm", game_name=data["game_name"], link=data.get("link", "")
+                )
+            self.send_chat(data["chat_id"], text)
+            metrics.inc("steamgifts_reminders_total", step=data["step"])
+
+        if expire_after <= 0:
+            return
+
+        expired = []
+        for data in self.conversations.due_expiry(now - expire_after):
+            order_id = data["order_id"]
+            if self.conversations.expire(order_id) is None:
+                logger.debug("[SteamGifts] Order %s moved on before expiry", order_id)
+                continue
+            expired.append(data)
+            self.observe_wait(data)
+            metrics.inc("steamgifts_orders_total", result="expired")
+            self.send_chat(data["chat_id"], self.config_store.format_template("order_expired", game_name=data["game_name"]))
+            if options.get("refund_expired"):
+                self.try_refund(self.cardinal, order_id, "Order expired")
+            logger.info("[SteamGifts] Order %s expired at step %s", order_id, data["step"])
+
+        if expired:
+            self.notify_owner(
+                "⌛ <b>Steam Gifts</b>\n\n"
+                f"Закрыто заказов без ответа покупателя: {len(expired)}\n"
+                + ", ".join(f"<code>#{data['order_id']}</code>" for data in expired[:20])
+            )
+
+    def start_status_tracking(self) -> None:
+        options = self.config.get("status_tracking", {})
+        if not options.get("enabled"):
+            return
+
+        self.status_tracker = ProviderStatusTracker.from_config(
+            self.poll_provider_statuses, self.on_provider_status, options
+        )
+        for entry in self.ledger.entries():
+            if entry["state"] == DispatchLedger.SENT and entry.get("provider_order_id") and entry.get("chat_id"):
+                self.status_tracker.track(
+                    entry["provider_order_id"],
+                    status=entry.get("provider_status", ""),
+                    created=entry.get("ts"),
+                    key=entry["key"],
+                    order_id=entry["order_id"],
+                    chat_id=entry["chat_id"],
+                    game_name=entry.get("game_name", ""),
+                )
+        if len(self.status_tracker):
+            logger.info("[SteamGifts] Tracking %s provider orders", len(self.status_tracker))
+
+        tick = max(1.0, float(options.get("tick", 15)))
+        self._jobs.append(scheduler.call_every(tick, self.status_tracker.poll_due))
+
+    def track_provider_orders(self, data: dict, items: list[dict], results: list[dict]) -> None:
+        if self.status_tracker is None:
+            return
+        for item, result in zip(items, results):
+            if not result["success"] or not result.get("provider_order_id"):
+                continue
+            key = item["idempotency_key"]
+            # Данные заказа нужны, чтобы вернуть его на сверку, если провайдер не доставит гифт
+            order = {field: value for field, value in data.items() if field not in ("step", "step_at", "parked_at")}
+            self.ledger.annotate(key, chat_id=data["chat_id"], game_name=data["game_name"], order=order)
+            self.status_tracker.track(
+                result["provider_order_id"],
+                status=result.get("provider_status", ""),
+                key=key,
+                order_id=data["order_id"],
+                chat_id=data["chat_id"],
+                game_name=data["game_name"],
+            )
+
+    def poll_provider_statuses(self, provider_ids: list[str]) -> dict[str, str]:
+        if not self.api_client:
+            raise RuntimeError("API клиент не настроен")
+        endpoint = self.config.get("status_tracking", {}).get("endpoint", "steam_gift/order_status")
+        return self.api_client.get_order_statuses(provider_ids, endpoint)
+
+    def on_provider_status(self, entry: dict, old: str, new: str) -> None:
+        self.ledger.annotate(entry["key"], provider_status=new)
+        metrics.inc("steamgifts_provider_status_total", status=new)
+        logger.info("[SteamGifts] Provider order %s: %s -> %s", entry["provider_id"], old or "-", new)
+
+        label = ProviderStatusTracker.LABELS.get(new, new)
+        if new in ProviderStatusTracker.FAILURE:
+            reopened = self.reopen_failed_gift(entry, new)
+            self.send_chat(
+                entry["chat_id"],
+                self.config_store.format_template("gift_failed", game_name=entry["game_name"], status=label),
+            )
+            self.notify_owner(
+                "❌ <b>Steam Gifts</b>\n\n"
+                f"Заказ <code>#{entry['order_id']}</code> ({entry['game_name']}): гифт не доставлен\n"
+                f"Статус ns.gifts: {new} (заказ провайдера {entry['provider_id']})\n\n"
+                + (
+                    "Заказ возвращён в /gift_steam → ⚠️ Сверка: отправьте гифт повторно или верните средства"
+                    if reopened
+                    else "Обработайте его вручную"
+                )
+            )
+        elif new not in ProviderStatusTracker.SILENT:
+            self.send_chat(
+                entry["chat_id"],
+                self.config_store.format_template("gift_status", game_name=entry["game_name"], status=label),
+            )
+
+    def reopen_failed_gift(self, entry: dict, status: str) -> bool:
+        # Провайдер не доставил гифт: отправка отмечается неудачной, учёт заказа отменяется,
+        # а сам заказ возвращается на сверку владельцу
+        key = entry["key"]
+        sent = self.ledger.get(key)
+        if sent is None or sent["state"] != DispatchLedger.SENT:
+            return False
+        self.ledger.finish(key, DispatchLedger.FAILED, provider_status=status)
+        if self.balance:
+            # Средства за недоставленный гифт возвращаются на баланс ns.gifts
+            self.balance.invalidate()
+
+        order = sent.get("order")
+        if not order:
+            return False
+        current = self.conversations.get(order["order_id"])
+        if current is not None:
+            # Заказ ещё в обработке и не учтён: неудачная отправка не войдёт в его запись
+            return current["step"] == "reconcile"
+
+        if sent.get("recorded_ts"):
+            recorded_ts = sent["recorded_ts"]
+            self.record_order(
+                {
+                    **self.make_journal_record(order),
+                    "timestamp": datetime.fromtimestamp(recorded_ts).strftime("%Y-%m-%d %H:%M:%S"),
+                    "ts": recorded_ts,
+                    "reversed": True,
+                }
+            )
+        self.conversations.add({**order, "step": "reconcile", "step_at": time.time()})
+        metrics.inc("steamgifts_orders_total", result="reopened")
+        logger.warning(
+            "[SteamGifts] Gift %s failed at provider (%s), order %s held for reconciliation", key, status, order["order_id"]
+        )
+        return True
+
+    def on_breaker_change(self, previous: str, state: str) -> None:
+        if state == CircuitBreaker.OPEN and previous == CircuitBreaker.CLOSED:
+            self.notify_owner(
+                "⚠️ <b>Steam Gifts</b>\n\n"
+                "NS.Gifts не отвечает. Новые заказы откладываются в очередь и будут отправлены после восстановления"
+            )
+        elif state == CircuitBreaker.CLOSED:
+            self.notify_owner(
+                "✅ <b>Steam Gifts</b>\n\n"
+                f"NS.Gifts снова доступен. Отложенных заказов: {self.conversations.parked_count}"
+            )
+
+    def complete_order(self, data: dict, **fields) -> int:
+        # Одна запись журнала на заказ, когда он окончательно выходит из обработки:
+        # гифты, отправленные до парковки или сверки, учитываются вместе с остальными
+        if not self.ledger:
+            return 0
+        sent = [entry for entry in self.ledger.order_entries(data["order_id"]) if entry["state"] == DispatchLedger.SENT]
+        if sent:
+            provider_ids = [entry["provider_order_id"] for entry in sent if entry.get("provider_order_id")]
+            record = {
+                **self.make_journal_record(data),
+                "quantity": len(sent),
+                "provider_order_ids": provider_ids,
+                **fields,
+            }
+            self.record_order(record)
+            for entry in sent:
+                # Время записи нужно для отмены учёта, если отслеживаемый гифт не будет доставлен
+                if entry.get("order"):
+                    self.ledger.annotate(entry["key"], recorded_ts=record["ts"])
+        return len(sent)
+
+    def record_order(self, record: dict) -> None:
+        self.journal.append(record)
+        self.stats.add(record)
+        self.analytics.add(record)
+
+    def make_journal_record(self, data: dict) -> dict:
+        return {
+            "order_id": data["order_id"],
+            "buyer_id": data["buyer_id"],
+            "game_name": data["game_name"],
+            "region": data["region"],
+            "link": data.get("link"),
+            "revenue": data["revenue"],
+            "lot_id": data.get("lot_id"),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "ts": time.time(),
+        }
 
     def try_refund(self, c: Cardinal, order_id: int, reason: str) -> bool:
         if not self.config.get("auto_refunds", False):
@@ -466,6 +3636,7 @@ class SteamGiftPlugin:
             logger.info("[SteamGifts] Refunded order %s: %s", order_id, reason)
             return True
         except Exception as exc:
+            metrics.inc("steamgifts_errors_total", cause="refund")
             logger.error("[SteamGifts] Refund error for %s: %s", order_id, exc)
             return False
 
@@ -473,7 +3644,7 @@ class SteamGiftPlugin:
         kb = K(row_width=2)
 
         auth_status = "✅" if self.config.get("api_login") and self.config.get("api_password") else "❌"
-        lots_count = len(self.config.get("lot_game_mapping", {}))
+        lots_count = len(self.lots)
 
         kb.row(
             B(f"🔐 Авторизация {auth_status}", callback_data=self.cb_auth),
@@ -485,7 +3656,14 @@ class SteamGiftPlugin:
         )
 
         refunds = "✅" if self.config.get("auto_refunds") else "❌"
-        kb.add(B(f"💸 Авторефунды {refunds}", callback_data=self.cb_toggle_refunds))
+        kb.row(
+            B(f"💸 Авторефунды {refunds}", callback_data=self.cb_toggle_refunds),
+            B("📝 Шаблоны", callback_data=self.cb_templates),
+        )
+
+        reconcile_count = len(self.get_reconcile_orders())
+        if reconcile_count:
+            kb.add(B(f"⚠️ Сверка ({reconcile_count})", callback_data=self.cb_reconcile))
 
         return kb
 
@@ -495,14 +3673,19 @@ class SteamGiftPlugin:
             f"{api_login[:4]}...{api_login[-4:]}" if len(api_login) > 8 else ("Не указан" if not api_login else api_login)
         )
 
-        lots_count = len(self.config.get("lot_game_mapping", {}))
-        orders_count = len(self.order_history)
+        lots_count = len(self.lots)
+        orders_count = self.stats.total_orders
+        if self.balance and self.balance.value is not None:
+            balance_display = f"{self.balance.value:.2f} руб."
+        else:
+            balance_display = "—"
 
         text = f"""<b>🎮 Steam Gifts - Панель управления</b>
 
 <b>Логин:</b> <code>{login_display}</code>
 <b>Настроено лотов:</b> {lots_count}
 <b>Всего заказов:</b> {orders_count}
+<b>Баланс:</b> {balance_display}
 
 <b>Авторефунды:</b> {'✅ Включены' if self.config.get('auto_refunds') else '❌ Выключеы'}
 """
@@ -585,8 +3768,8 @@ class SteamGiftPlugin:
         self.config_store.save()
 
         try:
-            self.api_client = NSGiftsAPIClient(TokenManager(login, password))
-            balance = self.api_client.get_balance()
+            self.setup_api_client(login, password)
+            balance = self.balance.refresh()
 
             self.bot.send_message(
                 chat_id,
@@ -619,30 +3802,37 @@ class SteamGiftPlugin:
             return
 
         try:
-            balance = self.api_client.get_balance()
-            self.bot.answer_callback_query(call.id, f"💰 Баланс: {balance} руб.")
+            if self.balance.value is not None:
+                text = f"💰 Баланс: {self.balance.value:.2f} руб. (обновлён {int(self.balance.age)} сек. назад)"
+                if self.balance.stale:
+                    scheduler.call_soon(self.refresh_balance)
+            else:
+                text = f"💰 Баланс: {self.balance.refresh():.2f} руб."
+            self.bot.answer_callback_query(call.id, text)
         except Exception as exc:
             self.bot.answer_callback_query(call.id, f"❌ Ошибка: {str(exc)}", show_alert=True)
 
+    def refresh_balance(self) -> None:
+        try:
+            self.balance.refresh()
+        except Exception as exc:
+            logger.error("[SteamGifts] Balance refresh error: %s", exc)
+
     def handle_stats_callback(self, call: CallbackQuery) -> None:
-        total_orders = len(self.order_history)
+        total_orders = self.stats.total_orders
 
         if total_orders == 0:
             text = "<b>📊 Статистика</b>\n\nНет заказов"
         else:
-            total_revenue = sum(order.get("revenue", 0) for order in self.order_history)
-            games: dict[str, int] = {}
-
-            for order in self.order_history:
-                game = order.get("game_name", "Unknown")
-                games[game] = games.get(game, 0) + 1
-
-            top_games = sorted(games.items(), key=lambda x: x[1], reverse=True)[:5]
+            total_revenue = self.stats.total_revenue
+            top_games = self.stats.top("by_game", 5)
+            regions = ", ".join(f"{region.upper()}: {count}" for region, count in self.stats.top("by_region", 5))
 
             text = f"""<b>📊 Статистика Steam Gifts</b>
 
 <b>Всего заказов:</b> {total_orders}
 <b>Общая выручка:</b> {total_revenue:.2f} руб.
+<b>По регионам:</b> {regions}
 
 <b>🏆 Топ-5 игр:</b>
 """
@@ -650,6 +3840,10 @@ class SteamGiftPlugin:
                 text += f"{i}. {game} — {count} шт.\n"
 
         kb = K()
+        kb.row(
+            B("📈 Аналитика", callback_data=self.cb_analytics),
+            B("⏱ Метрики", callback_data=self.cb_metrics),
+        )
         kb.add(B("🔙 Назад", callback_data=self.cb_back))
 
         self.bot.edit_message_text(
@@ -660,39 +3854,347 @@ class SteamGiftPlugin:
             reply_markup=kb,
         )
 
-    def handle_lots_callback(self, call: CallbackQuery) -> None:
-        lot_game_mapping = self.config.get("lot_game_mapping", {})
+    @staticmethod
+    def format_duration(seconds: float) -> str:
+        if seconds < 1:
+            return f"{seconds * 1000:.0f} мс"
+        if seconds < 120:
+            return f"{seconds:.1f} с"
+        return f"{seconds / 60:.1f} мин"
+
+    def format_histograms(self, name: str, label: str) -> str:
+        rows = []
+        for labels, hist in sorted(metrics.histogram_values(name), key=lambda item: item[0].get(label, "")):
+            p50, p95, p99 = (self.format_duration(hist.percentile(q)) for q in (0.5, 0.95, 0.99))
+            rows.append(f"• {labels.get(label)}: {p50} / {p95} / {p99} (n={hist.count})")
+        return "\n".join(rows) or "нет данных"
+
+    def handle_metrics_callback(self, call: CallbackQuery) -> None:
+        errors = sorted(metrics.counter_values("steamgifts_errors_total"), key=lambda item: -item[1])
+        orders = metrics.counter_values("steamgifts_orders_total")
+        gauges = metrics.gauge_values()
+
+        text = f"""<b>⏱ Метрики</b> <i>(p50 / p95 / p99)</i>
+
+<b>Этапы обработки:</b>
+{self.format_histograms("steamgifts_stage_seconds", "stage")}
+
+<b>Вызовы ns.gifts:</b>
+{self.format_histograms("steamgifts_api_seconds", "call")}
+
+<b>Ожидание покупателя:</b>
+{self.format_histograms("steamgifts_wait_seconds", "step")}
+
+<b>Заказы:</b> {", ".join(f"{labels['result']}: {value:g}" for labels, value in orders) or "нет данных"}
+<b>Ошибки:</b> {", ".join(f"{labels['cause']}: {value:g}" for labels, value in errors) or "нет"}
+<b>В очереди отправки:</b> {gauges.get("steamgifts_dispatch_pending", 0):g}
+<b>Сообщений в очереди:</b> {gauges.get("steamgifts_outbox_pending", 0):g}
+<b>Открытых заказов:</b> {gauges.get("steamgifts_open_orders", 0):g}
+"""
+        if self.transport and self.transport.breaker:
+            states = {CircuitBreaker.CLOSED: "✅ доступен", CircuitBreaker.HALF_OPEN: "🔄 проверка"}
+            text += (
+                f"<b>NS.Gifts:</b> {states.get(self.transport.breaker.state, '⚠️ недоступен')}, "
+                f"отложено заказов: {self.conversations.parked_count}\n"
+            )
+        if self.transport and self.transport.limiter:
+            waits = metrics.histogram_values("steamgifts_ratelimit_wait_seconds")
+            wait = waits[0][1] if waits else Histogram()
+            text += (
+                f"<b>Лимит запросов:</b> {self.transport.limiter.current_rate:.1f}/с, "
+                f"в очереди {self.transport.limiter.waiting}, "
+                f"ожидание p95 {self.format_duration(wait.percentile(0.95))}\n"
+            )
+
+        kb = K()
+        kb.add(B("🔄 Обновить", callback_data=self.cb_metrics))
+        kb.add(B("🔙 Назад", callback_data=self.cb_stats))
 
-        if not lot_game_mapping:
+        try:
+            self.bot.edit_message_text(
+                text,
+                call.message.chat.id,
+                call.message.id,
+                parse_mode="HTML",
+                reply_markup=kb,
+            )
+        except Exception as exc:
+            # Telegram отклоняет редактирование без изменений
+            logger.debug("[SteamGifts] Metrics panel not updated: %s", exc)
+        self.bot.answer_callback_query(call.id)
+
+    def handle_analytics_callback(self, call: CallbackQuery) -> None:
+        now = time.time()
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        month_ago = now - 30 * 86400
+
+        text = "<b>📈 Аналитика</b>\n\n"
+        for title, since in (("Сегодня", today), ("7 дней", now - 7 * 86400), ("30 дней", month_ago)):
+            count, revenue = self.analytics.summary(since)
+            text += f"<b>{title}:</b> {count} шт. / {revenue:.2f} руб.\n"
+
+        regions = sorted(self.analytics.group_by("region", month_ago).items(), key=lambda x: x[1][1], reverse=True)
+        if regions:
+            text += "\n<b>🌍 Регионы (30 дней):</b>\n"
+            for region, (count, revenue) in regions:
+                text += f"{region.upper()} — {count} шт. / {revenue:.2f} руб.\n"
+
+        lots = heapq.nlargest(5, self.analytics.group_by("lot", month_ago).items(), key=lambda x: x[1][1])
+        if lots:
+            text += "\n<b>🎮 Топ-5 лотов (30 дней):</b>\n"
+            for lot_id, (count, revenue) in lots:
+                text += f"<code>{lot_id}</code> — {count} шт. / {revenue:.2f} руб.\n"
+
+        kb = K()
+        kb.add(B("⏱ По часам", callback_data=self.cb_hourly))
+        kb.add(B("🔙 Назад", callback_data=self.cb_stats))
+
+        self.bot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.id,
+            parse_mode="HTML",
+            reply_markup=kb,
+        )
+
+    def handle_hourly_callback(self, call: CallbackQuery) -> None:
+        now = time.time()
+        hours = self.analytics.hourly(now - 23 * 3600, now)
+        peak = max(count for _, count in hours)
+
+        text = "<b>⏱ Заказы по часам (24 ч)</b>\n\n"
+        for hour_start, count in hours:
+            bar = "▇" * round(10 * count / peak) if peak else ""
+            text += f"<code>{datetime.fromtimestamp(hour_start).strftime('%H:00')}</code> {bar} {count}\n"
+
+        kb = K()
+        kb.add(B("🔙 Назад", callback_data=self.cb_analytics))
+
+        self.bot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.id,
+            parse_mode="HTML",
+            reply_markup=kb,
+        )
+
+    def render_lots_page(self, query: str, region: str, page: int) -> tuple[str, K, int]:
+        lots = self.lots.search(query, region)
+        pages = max(1, (len(lots) + LOTS_PAGE_SIZE - 1) // LOTS_PAGE_SIZE)
+        page = min(max(page, 0), pages - 1)
+
+        key = (self.lots.version, query, region, page)
+        cached = self._lot_pages.get(key)
+        if cached is not None:
+            return cached[0], cached[1], page
+        if len(self._lot_pages) > 256 or (self._lot_pages and next(iter(self._lot_pages))[0] != self.lots.version):
+            self._lot_pages.clear()
+
+        filters = []
+        if query:
+            filters.append(f"поиск «{html.escape(query)}»")
+        if region:
+            filters.append(f"регион {region.upper()}")
+
+        if not self.lots:
             text = "<b>🎮 Управление лотами</b>\n\n📭 Лоты не настроены"
+        elif not lots:
+            text = f"<b>🎮 Управление лотами ({len(self.lots)})</b>\n\n🔍 Ничего не найдено: {', '.join(filters)}"
         else:
-            text = f"<b>🎮 Управление лотами ({len(lot_game_mapping)})</b>\n\nНажмите для удаления:"
+            text = f"<b>🎮 Управление лотами ({len(self.lots)})</b>\n\n"
+            if filters:
+                text += f"🔍 Фильтр: {', '.join(filters)} — найдено {len(lots)}\n"
+            text += f"Страница {page + 1}/{pages}. Нажмите для удаления:"
 
         kb = K(row_width=1)
 
         region_emoji = {"ru": "🇷🇺", "ua": "🇺🇦", "kz": "🇰🇿"}
 
-        for lot_id, lot_data in lot_game_mapping.items():
-            if isinstance(lot_data, str):
-                game_name = lot_data
-                region = "ru"
-            else:
-                game_name = lot_data.get("name", "Unknown")
-                region = lot_data.get("region", "ru")
+        for lot in lots[page * LOTS_PAGE_SIZE : (page + 1) * LOTS_PAGE_SIZE]:
+            flag = region_emoji.get(lot.region, "🌍")
+            disabled = "" if lot.enabled else " ⏸"
+            kb.add(B(f"{flag} {lot.name} (ID: {lot.lot_id}){disabled}", callback_data=f"{self.cb_del_lot}{lot.lot_id}"))
 
-            flag = region_emoji.get(region, "🌍")
-            kb.add(B(f"{flag} {game_name} (ID: {lot_id})", callback_data=f"{self.cb_del_lot}{lot_id}"))
+        if pages > 1:
+            kb.row(
+                B("◀️", callback_data=f"{self.cb_lot_page}{(page - 1) % pages}"),
+                B(f"{page + 1}/{pages}", callback_data=f"{self.cb_lot_page}{page}"),
+                B("▶️", callback_data=f"{self.cb_lot_page}{(page + 1) % pages}"),
+            )
 
+        kb.row(
+            B("🔍 Поиск", callback_data=self.cb_lot_search),
+            B(f"🌍 Регион: {region.upper() or 'все'}", callback_data=self.cb_lot_region),
+        )
+        if filters:
+            kb.add(B("✖️ Сбросить фильтр", callback_data=self.cb_lot_reset))
         kb.add(B("➕ Добавить лот", callback_data=self.cb_add_lot))
+        kb.row(
+            B("📥 Импорт", callback_data=self.cb_lot_import),
+            B("📤 JSON", callback_data=f"{self.cb_lot_export}json"),
+            B("📤 CSV", callback_data=f"{self.cb_lot_export}csv"),
+        )
+        kb.add(B("🔎 Найти мои лоты на FunPay", callback_data=self.cb_lot_scan))
         kb.add(B("🔙 Назад", callback_data=self.cb_back))
 
-        self.bot.edit_message_text(
-            text,
+        self._lot_pages[key] = (text, kb)
+        return text, kb, page
+
+    def show_lots_page(self, chat_id: int, msg_id: int) -> None:
+        filters = self._lot_filters.setdefault(chat_id, {"query": "", "region": "", "page": 0})
+        text, kb, filters["page"] = self.render_lots_page(filters["query"], filters["region"], filters["page"])
+
+        try:
+            self.bot.edit_message_text(text, chat_id, msg_id, parse_mode="HTML", reply_markup=kb)
+        except Exception as exc:
+            logger.debug("[SteamGifts] Lots page not updated: %s", exc)
+
+    def handle_lots_callback(self, call: CallbackQuery) -> None:
+        chat_id = call.message.chat.id
+        filters = self._lot_filters.setdefault(chat_id, {"query": "", "region": "", "page": 0})
+        data = call.data
+
+        if data.startswith(self.cb_lot_page):
+            filters["page"] = int(data[len(self.cb_lot_page) :] or 0)
+        elif data == self.cb_lot_region:
+            regions = ("", *REGIONS)
+            filters["region"] = regions[(regions.index(filters["region"]) + 1) % len(regions)]
+            filters["page"] = 0
+        elif data == self.cb_lot_reset:
+            filters.update(query="", region="", page=0)
+
+        self.show_lots_page(chat_id, call.message.id)
+
+    def handle_lot_search_callback(self, call: CallbackQuery) -> None:
+        msg = self.bot.send_message(
             call.message.chat.id,
-            call.message.id,
+            "🔍 <b>Поиск лотов</b>\n\nВведите часть названия игры или ID лота:",
             parse_mode="HTML",
-            reply_markup=kb,
         )
+        self.bot.register_next_step_handler(msg, self.process_lot_search, call.message.chat.id, call.message.id)
+
+    def process_lot_search(self, message: TGMessage, chat_id: int, msg_id: int) -> None:
+        try:
+            self.bot.delete_message(chat_id, message.id - 1)
+            self.bot.delete_message(chat_id, message.id)
+        except Exception:
+            pass
+
+        filters = self._lot_filters.setdefault(chat_id, {"query": "", "region": "", "page": 0})
+        filters.update(query=(message.text or "").strip()[:32], page=0)
+        self.show_lots_page(chat_id, msg_id)
+
+    def handle_lot_export(self, call: CallbackQuery) -> None:
+        fmt = call.data[len(self.cb_lot_export) :]
+        data = self.lots.export_csv() if fmt == "csv" else self.lots.export_json()
+        self.bot.send_document(
+            call.message.chat.id,
+            io.BytesIO(data),
+            visible_file_name=f"steam_gifts_lots.{fmt}",
+            caption=f"🎮 Лотов: {len(self.lots)}",
+        )
+        self.bot.answer_callback_query(call.id)
+
+    def handle_lot_import_callback(self, call: CallbackQuery) -> None:
+        msg = self.bot.send_message(
+            call.message.chat.id,
+            (
+                "📥 <b>Импорт лотов</b>\n\n"
+                "Отправьте файл <b>.json</b> (как при экспорте) или <b>.csv</b> с колонками:\n"
+                f"<code>{','.join(LotCatalog.CSV_FIELDS)}</code>\n\n"
+                "Существующие лоты с теми же ID будут перезаписаны."
+            ),
+            parse_mode="HTML",
+        )
+        self.bot.register_next_step_handler(msg, self.process_lot_import, call.message.chat.id, call.message.id)
+
+    def process_lot_import(self, message: TGMessage, chat_id: int, msg_id: int) -> None:
+        document = getattr(message, "document", None)
+        if document is None:
+            self.bot.send_message(chat_id, "❌ Нужен файл .json или .csv")
+            return
+
+        try:
+            file_info = self.bot.get_file(document.file_id)
+            raw = self.bot.download_file(file_info.file_path)
+            records, errors = LotCatalog.parse_import(document.file_name or "", raw)
+        except Exception as exc:
+            self.bot.send_message(chat_id, f"❌ Не удалось прочитать файл: {exc}")
+            return
+
+        if errors:
+            shown = "\n".join(errors[:10])
+            more = f"\n…и ещё {len(errors) - 10}" if len(errors) > 10 else ""
+            self.bot.send_message(chat_id, f"❌ Импорт отменён, ошибки в файле:\n{shown}{more}")
+            return
+
+        self.lots.add_many(records)
+        self.config_store.save()
+        logger.info("[SteamGifts] Imported %s lots", len(records))
+
+        self.bot.send_message(chat_id, f"✅ Импортировано лотов: {len(records)}")
+        self.show_lots_page(chat_id, msg_id)
+
+    def handle_lot_scan_callback(self, call: CallbackQuery) -> None:
+        chat_id = call.message.chat.id
+        try:
+            account = self.cardinal.account
+            funpay_lots = account.get_user(account.id).get_lots()
+        except Exception as exc:
+            self.bot.answer_callback_query(call.id, f"❌ Ошибка FunPay: {exc}", show_alert=True)
+            return
+
+        proposals = []
+        for funpay_lot in funpay_lots:
+            lot_id = str(getattr(funpay_lot, "id", ""))
+            title = (getattr(funpay_lot, "description", None) or getattr(funpay_lot, "title", None) or "").strip()
+            if lot_id.isdigit() and title and lot_id not in self.lots:
+                # Найденные лоты не продаются, пока владелец не проверит игру и регион
+                proposals.append(LotRecord(lot_id, title, enabled=False))
+        self._lot_proposals[chat_id] = proposals
+
+        if not proposals:
+            text = "<b>🔎 Лоты FunPay</b>\n\nВсе ваши лоты уже настроены"
+        else:
+            text = f"<b>🔎 Найдено ненастроенных лотов: {len(proposals)}</b>\n\n"
+            text += "\n".join(f"<code>{lot.lot_id}</code> — {html.escape(lot.name)}" for lot in proposals[:20])
+            if len(proposals) > 20:
+                text += f"\n…и ещё {len(proposals) - 20}"
+            text += (
+                "\n\nЛоты добавляются выключенными ⏸: название лота используется как название игры, регион — RU. "
+                "Скачайте JSON, поправьте названия и регионы, поставьте \"enabled\": true "
+                "и загрузите через 📥 Импорт."
+            )
+
+        kb = K(row_width=1)
+        if proposals:
+            kb.add(B(f"⏸ Добавить выключенными ({len(proposals)})", callback_data=self.cb_lot_scan_apply))
+            kb.add(B("📤 Скачать JSON", callback_data=self.cb_lot_scan_export))
+        kb.add(B("🔙 Назад", callback_data=self.cb_lots))
+
+        self.bot.edit_message_text(text, chat_id, call.message.id, parse_mode="HTML", reply_markup=kb)
+
+    def handle_lot_scan_action(self, call: CallbackQuery) -> None:
+        chat_id = call.message.chat.id
+        proposals = [lot for lot in self._lot_proposals.get(chat_id, []) if lot.lot_id not in self.lots]
+        if not proposals:
+            self.bot.answer_callback_query(call.id, "❌ Нет лотов для добавления", show_alert=True)
+            return
+
+        if call.data == self.cb_lot_scan_export:
+            self.bot.send_document(
+                chat_id,
+                io.BytesIO(self.lots.export_json(proposals)),
+                visible_file_name="steam_gifts_funpay_lots.json",
+            )
+            self.bot.answer_callback_query(call.id)
+            return
+
+        self.lots.add_many(proposals)
+        self.config_store.save()
+        self._lot_proposals.pop(chat_id, None)
+        self.bot.answer_callback_query(call.id, f"Добавлено лотов: {len(proposals)}")
+        self.show_lots_page(chat_id, call.message.id)
 
     def handle_add_lot_callback(self, call: CallbackQuery) -> None:
         msg = self.bot.send_message(
@@ -715,7 +4217,7 @@ class SteamGiftPlugin:
             self.bot.send_message(chat_id, "❌ ID лота должен быть числом!")
             return
 
-        if lot_id in self.config.get("lot_game_mapping", {}):
+        if lot_id in self.lots:
             self.bot.delete_message(chat_id, message.id)
             self.bot.send_message(chat_id, f"❌ Лот {lot_id} уже существует!")
             return
@@ -784,11 +4286,7 @@ class SteamGiftPlugin:
 
         game_name = self._temp_lot_data.pop(lot_id)
 
-        self.config.setdefault("lot_game_mapping", {})
-        self.config["lot_game_mapping"][lot_id] = {
-            "name": game_name,
-            "region": region,
-        }
+        self.lots.add(LotRecord(lot_id, game_name, region))
         self.config_store.save()
 
         region_names = {"ru": "🇷🇺 Россия", "ua": "🇺🇦 Украина", "kz": "🇰🇿 Казахстан"}
@@ -806,30 +4304,18 @@ class SteamGiftPlugin:
         )
 
         self.bot.answer_callback_query(call.id, "Лот добавлен!")
-
-        import threading
-
-        def show_delayed() -> None:
-            time.sleep(2)
-            self.show_main_panel(call)
-
-        threading.Thread(target=show_delayed, daemon=True).start()
+        scheduler.call_later(2, self.show_main_panel, call)
 
     def handle_delete_lot(self, call: CallbackQuery) -> None:
         lot_id = call.data.replace(self.cb_del_lot, "")
 
-        lot_game_mapping = self.config.get("lot_game_mapping", {})
-
-        if lot_id in lot_game_mapping:
-            lot_data = lot_game_mapping[lot_id]
-            game_name = lot_data.get("name") if isinstance(lot_data, dict) else lot_data
+        lot = self.lots.remove(lot_id)
 
-            del self.config["lot_game_mapping"][lot_id]
+        if lot is not None:
             self.config_store.save()
+            self.bot.answer_callback_query(call.id, f"Лот '{lot.name}' удалён!")
 
-            self.bot.answer_callback_query(call.id, f"Лот '{game_name}' удалён!")
-
-        self.handle_lots_callback(call)
+        self.show_lots_page(call.message.chat.id, call.message.id)
 
     def handle_toggle_refunds(self, call: CallbackQuery) -> None:
         self.config["auto_refunds"] = not self.config.get("auto_refunds", False)
@@ -840,6 +4326,145 @@ class SteamGiftPlugin:
 
         self.show_main_panel(call)
 
+    def handle_templates_callback(self, call: CallbackQuery) -> None:
+        self.show_templates_panel(call.message.chat.id, call.message.id)
+
+    def show_templates_panel(self, chat_id: int, msg_id: int) -> None:
+        kb = K(row_width=2)
+        kb.add(*[B(name, callback_data=f"{self.cb_template}{name}") for name in TEMPLATE_FIELDS])
+        kb.add(B("🔙 Назад", callback_data=self.cb_back))
+
+        self.bot.edit_message_text(
+            "<b>📝 Шаблоны сообщений</b>\n\nВыберите шаблон для изменения:",
+            chat_id,
+            msg_id,
+            parse_mode="HTML",
+            reply_markup=kb,
+        )
+
+    def handle_template_edit(self, call: CallbackQuery) -> None:
+        name = call.data[len(self.cb_template) :]
+        if name not in TEMPLATE_FIELDS:
+            self.bot.answer_callback_query(call.id, "Неизвестный шаблон")
+            return
+
+        source = self.config.get("templates", {}).get(name) or DEFAULT_CONFIG["templates"][name]
+        fields = ", ".join(f"{{{field_name}}}" for field_name in sorted(TEMPLATE_FIELDS[name])) or "нет"
+        msg = self.bot.send_message(
+            call.message.chat.id,
+            (
+                f"📝 <b>{name}</b>\n\n"
+                f"<code>{html.escape(source)}</code>\n\n"
+                f"<b>Плейсхолдеры:</b> {fields}\n\n"
+                "Отправьте новый текст или - для текста по умолчанию:"
+            ),
+            parse_mode="HTML",
+        )
+        self.bot.register_next_step_handler(msg, self.process_template, call.message.chat.id, call.message.id, name)
+
+    def process_template(self, message: TGMessage, chat_id: int, msg_id: int, name: str) -> None:
+        try:
+            self.bot.delete_message(chat_id, message.id - 1)
+            self.bot.delete_message(chat_id, message.id)
+        except Exception:
+            pass
+
+        source = message.text or ""
+        if source.strip() == "-":
+            source = DEFAULT_CONFIG["templates"][name]
+
+        errors = self.config_store.set_template(name, source)
+        if errors:
+            self.bot.send_message(chat_id, "❌ Шаблон не сохранён:\n" + "\n".join(errors))
+            return
+
+        self.bot.send_message(chat_id, f"✅ Шаблон {name} сохранён")
+        self.show_templates_panel(chat_id, msg_id)
+
+    def get_reconcile_orders(self) -> list[dict]:
+        return [data for data in self.conversations.values() if data["step"] == "reconcile"]
+
+    def handle_reconcile_callback(self, call: CallbackQuery) -> None:
+        orders = self.get_reconcile_orders()
+
+        if not orders:
+            text = "<b>⚠️ Сверка заказов</b>\n\nНет заказов, требующих проверки"
+        else:
+            text = (
+                "<b>⚠️ Сверка заказов</b>\n\n"
+                "Эти заказы были прерваны во время отправки гифта или гифт не доставлен провайдером. "
+                "Проверьте их в ns.gifts и отметьте результат:\n"
+            )
+            for data in orders:
+                states = self.ledger.states(data["order_id"])
+                info = self.order_fetcher.cached(data["order_id"]) if self.order_fetcher else None
+                buyer = f" ({info.buyer_username})" if info and info.buyer_username else ""
+                text += f"\n<code>#{data['order_id']}</code>{buyer} — {data['game_name']}\n{data.get('link', '')}\n"
+                if states:
+                    text += (
+                        f"Отправлено: {states[DispatchLedger.SENT]}, "
+                        f"под вопросом: {states[DispatchLedger.UNKNOWN] + states[DispatchLedger.IN_FLIGHT]}, "
+                        f"не доставлено: {states[DispatchLedger.FAILED]}\n"
+                    )
+
+        kb = K(row_width=2)
+        for data in orders:
+            order_id = data["order_id"]
+            kb.row(
+                B(f"✅ #{order_id} выдан", callback_data=f"{self.cb_rc_done}{order_id}"),
+                B(f"🔁 #{order_id} отправить", callback_data=f"{self.cb_rc_resend}{order_id}"),
+            )
+            kb.add(B(f"💸 #{order_id} вернуть средства", callback_data=f"{self.cb_rc_refund}{order_id}"))
+        kb.add(B("🔙 Назад", callback_data=self.cb_back))
+
+        self.bot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.id,
+            parse_mode="HTML",
+            reply_markup=kb,
+        )
+
+    def handle_reconcile_action(self, call: CallbackQuery) -> None:
+        actions = (self.cb_rc_done, self.cb_rc_resend, self.cb_rc_refund)
+        action = next(prefix for prefix in actions if call.data.startswith(prefix))
+        order_key = call.data[len(action) :]
+
+        data = next((d for d in self.get_reconcile_orders() if str(d["order_id"]) == order_key), None)
+        if data is None:
+            self.bot.answer_callback_query(call.id, "❌ Заказ не найден", show_alert=True)
+            return
+
+        order_id = data["order_id"]
+        if action == self.cb_rc_refund:
+            try:
+                self.cardinal.account.refund(order_id)
+            except Exception as exc:
+                metrics.inc("steamgifts_errors_total", cause="refund")
+                logger.error("[SteamGifts] Refund error for %s: %s", order_id, exc)
+                self.bot.answer_callback_query(call.id, f"❌ Не удалось вернуть средства: {exc}", show_alert=True)
+                return
+            logger.info("[SteamGifts] Refunded order %s after reconciliation", order_id)
+            self.ledger.resolve(order_id, DispatchLedger.FAILED)
+            self.conversations.finish(order_id, "failed")
+            self.bot.answer_callback_query(call.id, f"Средства по заказу #{order_id} возвращены")
+        elif action == self.cb_rc_resend:
+            self.ledger.resolve(order_id, DispatchLedger.FAILED)
+            self.conversations.update(order_id, step="dispatching")
+            self.dispatcher.submit(order_id, self.process_purchase, self.cardinal, data)
+            self.bot.answer_callback_query(call.id, f"Заказ #{order_id} отправлен повторно")
+        else:
+            self.ledger.resolve(order_id, DispatchLedger.SENT)
+            if not self.complete_order(data, reconciled=True):
+                # По заказу нет записей об отправке: выдачу подтвердил владелец
+                self.record_order(
+                    {**self.make_journal_record(data), "quantity": data.get("quantity", 1), "reconciled": True}
+                )
+            self.conversations.finish(order_id, "done")
+            self.bot.answer_callback_query(call.id, f"Заказ #{order_id} отмечен выданным")
+
+        self.handle_reconcile_callback(call)
+
     def handle_back(self, call: CallbackQuery) -> None:
         self.show_main_panel(call)
 
@@ -852,8 +4477,24 @@ class SteamGiftPlugin:
             self.handle_balance_callback(call)
         elif data == self.cb_stats:
             self.handle_stats_callback(call)
-        elif data == self.cb_lots:
+        elif data == self.cb_analytics:
+            self.handle_analytics_callback(call)
+        elif data == self.cb_hourly:
+            self.handle_hourly_callback(call)
+        elif data == self.cb_metrics:
+            self.handle_metrics_callback(call)
+        elif data in (self.cb_lots, self.cb_lot_region, self.cb_lot_reset) or data.startswith(self.cb_lot_page):
             self.handle_lots_callback(call)
+        elif data == self.cb_lot_search:
+            self.handle_lot_search_callback(call)
+        elif data.startswith(self.cb_lot_export):
+            self.handle_lot_export(call)
+        elif data == self.cb_lot_import:
+            self.handle_lot_import_callback(call)
+        elif data == self.cb_lot_scan:
+            self.handle_lot_scan_callback(call)
+        elif data in (self.cb_lot_scan_apply, self.cb_lot_scan_export):
+            self.handle_lot_scan_action(call)
         elif data == self.cb_add_lot:
             self.handle_add_lot_callback(call)
         elif data.startswith(self.cb_del_lot):
@@ -862,6 +4503,14 @@ class SteamGiftPlugin:
             self.handle_region_selection(call)
         elif data == self.cb_toggle_refunds:
             self.handle_toggle_refunds(call)
+        elif data == self.cb_templates:
+            self.handle_templates_callback(call)
+        elif data.startswith(self.cb_template):
+            self.handle_template_edit(call)
+        elif data == self.cb_reconcile:
+            self.handle_reconcile_callback(call)
+        elif data.startswith((self.cb_rc_done, self.cb_rc_resend, self.cb_rc_refund)):
+            self.handle_reconcile_action(call)
         elif data == self.cb_back:
             self.handle_back(call)
         else:
@@ -884,11 +4533,13 @@ def init_commands(c: Cardinal) -> None:
 
 
 def handle_new_order(c: Cardinal, event: NewOrderEvent) -> None:
-    plugin.handle_new_order(c, event)
+    with metrics.timer("steamgifts_stage_seconds", stage="new_order"):
+        plugin.handle_new_order(c, event)
 
 
 def handle_new_message(c: Cardinal, event: NewMessageEvent) -> None:
-    plugin.handle_new_message(c, event)
+    with metrics.timer("steamgifts_stage_seconds", stage="new_message"):
+        plugin.handle_new_message(c, event)
 
 
 def cleanup(c: Cardinal) -> None:
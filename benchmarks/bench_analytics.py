@@ -0,0 +1,94 @@
+"""Бенчмарк OrderAnalytics на синтетической истории заказов
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_analytics.py --orders 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogiftsteam import REGIONS, OrderAnalytics  # noqa: E402
+
+DAY = 86400
+
+
+def make_records(count: int, days: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    now = time.time()
+    games = [f"Game {i}" for i in range(300)]
+    lots = [str(100000 + i) for i in range(500)]
+    records = []
+    for _ in range(count):
+        ts = now - rng.random() * days * DAY
+        records.append(
+            {
+                "ts": ts,
+                "timestamp": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+                "game_name": rng.choice(games),
+                "region": rng.choice(REGIONS),
+                "lot_id": rng.choice(lots),
+                "revenue": round(rng.uniform(50, 3000), 2),
+            }
+        )
+    return records
+
+
+def scan_summary(records: list[dict], since: float) -> tuple[int, float]:
+    # Прежний способ: разбор строковых дат при каждом запросе
+    count, revenue = 0, 0.0
+    for record in records:
+        if datetime.strptime(record["timestamp"], "%Y-%m-%d %H:%M:%S").timestamp() >= since:
+            count += 1
+            revenue += record["revenue"]
+    return count, revenue
+
+
+def timed(label: str, func, *args, repeat: int = 1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{label:<32} {elapsed * 1000:10.2f} ms")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scan", action="store_true", help="сравнить с построчным разбором истории")
+    args = parser.parse_args()
+
+    records = make_records(args.orders, args.days, args.seed)
+    random.Random(args.seed).shuffle(records)
+    now = time.time()
+
+    analytics = OrderAnalytics()
+    timed(f"load {len(records)} orders", analytics.load, records)
+    timed("first query (sort)", analytics.summary, now - DAY, None)
+
+    for label, days in (("today", 1), ("7d", 7), ("30d", 30)):
+        timed(f"summary {label}", analytics.summary, now - days * DAY, None, repeat=args.repeat)
+    timed("group_by region 30d", analytics.group_by, "region", now - 30 * DAY, None, repeat=args.repeat)
+    timed("group_by lot 30d", analytics.group_by, "lot", now - 30 * DAY, None, repeat=args.repeat)
+    timed("group_by game all", analytics.group_by, "game", None, None, repeat=args.repeat)
+    timed("hourly 24h", analytics.hourly, now - 23 * 3600, now, repeat=args.repeat)
+    if args.scan:
+        timed("scan summary 30d", scan_summary, records, now - 30 * DAY)
+
+    size = sum(column.itemsize * len(column) for column in (analytics.ts, analytics.revenue, *analytics.ids.values()))
+    print(f"{'column memory':<32} {size / 1024 / 1024:10.2f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Бенчмарк сохранения конфига: синхронная запись на каждый save() против отложенной со склейкой
+
+Потоки имитируют обработчики, которые пачками меняют лоты и отмечают заказы, вызывая save()
+после каждого изменения. Для каждого режима выводятся задержка save() в обработчике,
+число записей на диск и сколько сохранений склеено.
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_config.py --threads 8 --bursts 20 --burst-size 25 --delay 0.2
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogiftsteam import DEFAULT_CONFIG, ConfigStore, scheduler  # noqa: E402
+
+
+def make_store(storage_dir: str, lots: int, flush_delay: float) -> ConfigStore:
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    config["lot_game_mapping"] = {
+        str(100000 + i): {"name": f"Game {i}", "region": "ru", "enabled": True} for i in range(lots)
+    }
+    path = os.path.join(storage_dir, "config.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(config, file, ensure_ascii=False, indent=4)
+
+    store = ConfigStore(path, storage_dir, DEFAULT_CONFIG, flush_delay=flush_delay)
+    store.load()
+    return store
+
+
+def percentiles(values: list[float]) -> str:
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return f"p50 {at(0.5):7.3f}  p99 {at(0.99):7.3f}  max {values[-1] * 1000:7.3f} ms"
+
+
+def run(label: str, storage_dir: str, flush_delay: float, args) -> None:
+    store = make_store(storage_dir, args.lots, flush_delay)
+    writes = 0
+    write = store._write
+
+    def counting_write(data: str) -> None:
+        nonlocal writes
+        writes += 1
+        write(data)
+
+    store._write = counting_write
+    latencies: list[list[float]] = [[] for _ in range(args.threads)]
+    lot_ids = list(store.config["lot_game_mapping"])
+
+    def handler(index: int) -> None:
+        own = latencies[index]
+        for burst in range(args.bursts):
+            for i in range(args.burst_size):
+                lot = store.config["lot_game_mapping"][lot_ids[(index * 7919 + burst * 31 + i) % len(lot_ids)]]
+                lot["enabled"] = not lot["enabled"]
+                started = time.perf_counter()
+                store.save()
+                own.append(time.perf_counter() - started)
+            time.sleep(args.pause)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=handler, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+    elapsed = time.perf_counter() - started
+
+    with open(store.config_path, "r", encoding="utf-8") as file:
+        assert json.load(file) == store.config, "файл конфига не совпадает с состоянием после close()"
+
+    saves = sum(len(values) for values in latencies)
+    print(f"{label}")
+    print(f"  save() in handler  {percentiles([value for values in latencies for value in values])}")
+    print(f"  saves: {saves}, disk writes: {writes}, coalesced: {saves - writes}, elapsed: {elapsed:.2f} s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8, help="одновременных обработчиков")
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--burst-size", type=int, default=25, help="изменений подряд в одной пачке")
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза между пачками, с")
+    parser.add_argument("--lots", type=int, default=300, help="лотов в конфиге")
+    parser.add_argument("--delay", type=float, default=0.2, help="config_flush_delay отложенного режима, с")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="steamgifts-bench-")
+    try:
+        run("synchronous (config_flush_delay: 0)", storage_dir, 0.0, args)
+        run(f"write-behind (config_flush_delay: {args.delay:g})", storage_dir, args.delay, args)
+    finally:
+        scheduler.stop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
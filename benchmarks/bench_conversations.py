@@ -0,0 +1,129 @@
+"""Бенчмарк обработки сообщений FunPay при росте числа открытых заказов
+
+Стоимость сообщения не должна зависеть от числа открытых заказов: посторонние сообщения
+отсекаются по индексу покупателей, сообщения покупателя находят его заказ по индексу чата.
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_conversations.py --sizes 10,1000,10000 --messages 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import autogiftsteam  # noqa: E402
+from fakes import FakeAccount, FakeCardinal  # noqa: E402
+
+LOT_ID = "1000"
+# Покупатели с открытыми заказами — 1..size, остальные авторы к гифтам отношения не имеют
+STRANGER = 10**9
+
+
+def make_plugin(storage_dir: str) -> tuple[autogiftsteam.SteamGiftPlugin, FakeCardinal]:
+    config = json.loads(json.dumps(autogiftsteam.DEFAULT_CONFIG))
+    config["lot_game_mapping"] = {LOT_ID: {"name": "Bench Game", "region": "ru"}}
+    config["outbox"]["rate"] = 0
+    with open(os.path.join(storage_dir, "config.json"), "w", encoding="utf-8") as file:
+        json.dump(config, file, ensure_ascii=False, indent=4)
+
+    cardinal = FakeCardinal(FakeAccount(LOT_ID))
+    plugin = autogiftsteam.SteamGiftPlugin(storage_dir=storage_dir)
+    autogiftsteam.plugin = plugin
+    autogiftsteam.init_commands(cardinal)
+    return plugin, cardinal
+
+
+def open_orders(plugin: autogiftsteam.SteamGiftPlugin, size: int) -> dict[int, dict]:
+    plugin.conversations.clear()
+    orders = {}
+    for buyer_id in range(1, size + 1):
+        data = {
+            "buyer_id": buyer_id,
+            "step": "await_link",
+            "chat_id": FakeAccount.chat_of(buyer_id),
+            "game_name": "Bench Game",
+            "region": "ru",
+            "sub_id": 0,
+            "order_id": buyer_id,
+            "revenue": 100.0,
+            "lot_id": LOT_ID,
+            "cost": None,
+            "quantity": 1,
+            "step_at": time.time(),
+        }
+        plugin.conversations.add(data, persist=False)
+        orders[buyer_id] = dict(data)
+    return orders
+
+
+def message(author_id: int, text: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        message=SimpleNamespace(chat_id=FakeAccount.chat_of(author_id), author_id=author_id, content=text)
+    )
+
+
+def legacy_lookup(waiting_for_link: dict[int, dict], author_id: int) -> dict | None:
+    # Прежний обработчик: копия словаря и перебор всех открытых заказов на каждое сообщение
+    for _, data in list(waiting_for_link.items()):
+        if data["buyer_id"] == author_id:
+            return data
+    return None
+
+
+def run(label: str, func, events: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for event in events:
+            func(event)
+        best = min(best, time.perf_counter() - started)
+    per_message = best * 1e9 / len(events)
+    print(f"  {label:<26} {per_message:10.0f} ns/message")
+    return per_message
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,10000", help="число открытых заказов, через запятую")
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    storage_dir = tempfile.mkdtemp(prefix="steamgifts-bench-")
+    plugin, cardinal = make_plugin(storage_dir)
+    hook = autogiftsteam.handle_new_message
+
+    try:
+        for size in (int(value) for value in args.sizes.split(",")):
+            orders = open_orders(plugin, size)
+            strangers = [message(STRANGER + i, "Здравствуйте, есть в наличии?") for i in range(args.messages)]
+            buyers = [message(1 + i % size, "Здравствуйте, а когда придёт игра?") for i in range(args.messages)]
+
+            print(f"open orders: {size}")
+            run("unrelated message", lambda event: hook(cardinal, event), strangers, args.repeat)
+            run("buyer message", lambda event: hook(cardinal, event), buyers, args.repeat)
+            # Перебор медленный, для него хватает части сообщений
+            sample = strangers[: max(1, min(len(strangers), 10**7 // max(size, 1)))]
+            run("legacy scan, unrelated", lambda event: legacy_lookup(orders, event.message.author_id), sample, 1)
+            # Сообщения покупателей складываются в очередь чата, между прогонами она сбрасывается
+            plugin.outbox.stop()
+            plugin.outbox.start()
+    finally:
+        plugin.shutdown()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
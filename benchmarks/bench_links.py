@@ -0,0 +1,83 @@
+"""Микробенчмарк разбора ссылок на Steam профиль в сообщениях чата
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_links.py --messages 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogiftsteam import SteamLinkParser  # noqa: E402
+
+MESSAGES = (
+    "https://steamcommunity.com/id/{vanity}",
+    "https://steamcommunity.com/id/{vanity}/",
+    "https://steamcommunity.com/profiles/{steamid}",
+    "http://www.steamcommunity.com/profiles/{steamid}/?l=russian",
+    "https://m.steamcommunity.com/id/{vanity}/home",
+    "вот мой профиль https://steamcommunity.com/id/{vanity} спасибо",
+    "Держи: steamcommunity.com/profiles/{steamid}, жду гифт",
+    "+",
+    "-",
+    "Здравствуйте, а когда придёт игра?",
+    "https://store.steampowered.com/app/381210/",
+    "https://steamcommunity.com/id/",
+    "ссылка https://vk.com/{vanity} и ещё https://steamcommunity.com/id/{vanity}",
+    "Добрый день! " * 20,
+)
+
+
+def make_corpus(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        vanity = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789_") for _ in range(rng.randint(3, 20)))
+        steamid = f"7656119{rng.randrange(10**10):010d}"
+        corpus.append(rng.choice(MESSAGES).format(vanity=vanity, steamid=steamid))
+    return corpus
+
+
+def legacy_parse(text: str) -> str | None:
+    # Прежний разбор: поиск любой ссылки, затем проверка некомпилированным шаблоном
+    link_match = re.search(r"https?://[^\s]+", text)
+    if not link_match:
+        return None
+    link = link_match.group(0)
+    if re.match(r"https?://steamcommunity\.com/(id|profiles)/[A-Za-z0-9_-]+", link):
+        return link
+    return None
+
+
+def run(label: str, func, corpus: list[str], repeat: int) -> int:
+    best = float("inf")
+    found = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        found = sum(1 for text in corpus if func(text) is not None)
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<12} {best * 1e9 / len(corpus):8.0f} ns/message  {found} links")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages, args.seed)
+    run("legacy", legacy_parse, corpus, args.repeat)
+    run("parser", SteamLinkParser().parse, corpus, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Нагрузочный бенчмарк плагина на локальных заглушках FunPay, Telegram и ns.gifts
+
+Покупатели проходят весь сценарий: новый заказ → ссылка на профиль → «+» → гифт.
+События подаются в обработчики плагина из одного потока, как это делает Cardinal.
+В конце проверяется, что каждый гифт дошёл до ns.gifts один раз и что медленный API
+не задерживает обработчик событий; при нарушении скрипт завершается с кодом 1.
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_plugin.py --orders 2000 --buyers 50 --latency 0.05 --error-rate 0.01
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import autogiftsteam  # noqa: E402
+from fakes import FakeAccount, FakeCardinal, FakeNSGifts, message_event, order_event  # noqa: E402
+
+LOT_ID = "1000"
+# Шаги, после которых заказ ждёт владельца, а не покупателя
+HELD_STEPS = ("reconcile",)
+
+
+class EventThread:
+    """Очередь событий FunPay с одним потоком-обработчиком"""
+
+    def __init__(self, cardinal: FakeCardinal) -> None:
+        self.cardinal = cardinal
+        self.handle_times: list[float] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="bench-events", daemon=True)
+        self._thread.start()
+
+    def post(self, hook, event) -> None:
+        self._queue.put((hook, event))
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            hook, event = item
+            started = time.perf_counter()
+            try:
+                hook(self.cardinal, event)
+            except Exception as exc:
+                print(f"event handler error: {exc!r}", file=sys.stderr)
+            self.handle_times.append(time.perf_counter() - started)
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "нет данных"
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return f"p50 {at(0.5):8.1f}  p95 {at(0.95):8.1f}  p99 {at(0.99):8.1f}  max {values[-1] * 1000:8.1f} ms"
+
+
+def write_config(storage_dir: str, url: str, args) -> None:
+    config = json.loads(json.dumps(autogiftsteam.DEFAULT_CONFIG))
+    config.update(
+        api_login="bench@example.com",
+        api_password="bench",
+        token_cache=False,
+        dispatch_workers=args.workers,
+        lot_game_mapping={LOT_ID: {"name": "Bench Game", "region": "ru"}},
+    )
+    config["http"].update(base_url=f"{url}/api/v1", retries=0)
+    config["http"]["rate_limit"]["rate"] = args.rate
+    config["outbox"]["rate"] = 0
+    os.makedirs(storage_dir, exist_ok=True)
+    with open(os.path.join(storage_dir, "config.json"), "w", encoding="utf-8") as file:
+        json.dump(config, file, ensure_ascii=False, indent=4)
+
+
+def run_buyer(plugin, account: FakeAccount, events: EventThread, order_id: int, timeout: float) -> tuple:
+    chat_id = account.chat_of(order_id)
+    deadline = time.perf_counter() + timeout
+
+    def wait_messages(count: int) -> bool:
+        with account.changed:
+            while len(account.messages[chat_id]) < count:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                account.changed.wait(remaining)
+        return True
+
+    def finished() -> bool:
+        data = plugin.conversations.get(order_id)
+        return data is None or data["step"] in HELD_STEPS
+
+    started = time.perf_counter()
+    events.post(autogiftsteam.handle_new_order, order_event(order_id, LOT_ID))
+    if not wait_messages(1):
+        return "timeout", None, None
+
+    events.post(autogiftsteam.handle_new_message, message_event(order_id, f"https://steamcommunity.com/id/buyer{order_id}"))
+    if not wait_messages(2):
+        return "timeout", None, None
+
+    confirmed = time.perf_counter()
+    events.post(autogiftsteam.handle_new_message, message_event(order_id, "+"))
+    with account.changed:
+        while not finished():
+            if time.perf_counter() >= deadline:
+                return "timeout", None, None
+            account.changed.wait(0.05)
+    done = time.perf_counter()
+    return "done", done - started, done - confirmed
+
+
+def report_histograms(name: str, label: str) -> None:
+    for labels, hist in sorted(autogiftsteam.metrics.histogram_values(name), key=lambda item: item[0].get(label, "")):
+        p50, p95, p99 = (hist.percentile(q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"  {labels.get(label):<24} p50 {p50:8.1f}  p95 {p95:8.1f}  p99 {p99:8.1f} ms  (n={hist.count})")
+
+
+def check_dispatch(plugin, fake: FakeNSGifts, events: EventThread, results: list, args) -> list[str]:
+    problems = []
+    duplicates = {key: count for key, count in fake.orders.items() if count > 1}
+    if duplicates:
+        problems.append(f"гифты приняты ns.gifts повторно: {dict(list(duplicates.items())[:5])}")
+
+    entries = plugin.ledger.entries()
+    units = Counter(str(entry["order_id"]) for entry in entries)
+    repeated = [order_id for order_id, count in units.items() if count > 1]
+    if repeated:
+        problems.append(f"в журнале отправок больше одной записи на заказ: {repeated[:5]}")
+
+    done = sum(1 for result in results if result[0] == "done")
+    if not args.error_rate and done == args.orders:
+        sent = sum(1 for entry in entries if entry["state"] == "sent")
+        create_orders = fake.calls["steam_gift/create_order"]
+        if not sent == create_orders == len(fake.orders) == args.orders:
+            problems.append(
+                f"заказов {args.orders}, отправлено по журналу {sent}, "
+                f"запросов create_order {create_orders}, принято ns.gifts {len(fake.orders)}"
+            )
+
+    handle_times = sorted(events.handle_times)
+    p99 = handle_times[min(len(handle_times) - 1, int(0.99 * len(handle_times)))] if handle_times else 0.0
+    if p99 * 1000 > args.max_handler_ms:
+        problems.append(f"p99 обработчика событий {p99 * 1000:.1f} ms > {args.max_handler_ms:g} ms")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--buyers", type=int, default=50, help="одновременно активных покупателей")
+    parser.add_argument("--workers", type=int, default=4, help="dispatch_workers плагина")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа ns.gifts, с")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 от ns.gifts")
+    parser.add_argument("--rate", type=float, default=0, help="http.rate_limit.rate, 0 — без лимита")
+    parser.add_argument("--timeout", type=float, default=120, help="предел на один заказ, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-handler-ms", type=float, default=50, help="допустимый p99 обработчика событий, ms")
+    parser.add_argument("--tracemalloc", action="store_true", help="пиковая память Python (замедляет прогон)")
+    parser.add_argument("--keep", action="store_true", help="не удалять каталог с данными плагина")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    storage_dir = tempfile.mkdtemp(prefix="steamgifts-bench-")
+    fake = FakeNSGifts(args.latency, args.jitter, args.error_rate, args.seed).start()
+    write_config(storage_dir, fake.url, args)
+
+    account = FakeAccount(LOT_ID)
+    cardinal = FakeCardinal(account)
+    plugin = autogiftsteam.SteamGiftPlugin(storage_dir=storage_dir)
+    autogiftsteam.plugin = plugin
+    autogiftsteam.metrics.reset()
+    autogiftsteam.init_commands(cardinal)
+    events = EventThread(cardinal)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.buyers, thread_name_prefix="bench-buyer") as pool:
+        results = list(
+            pool.map(
+                lambda order_id: run_buyer(plugin, account, events, order_id, args.timeout),
+                range(1, args.orders + 1),
+            )
+        )
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    events.stop()
+    plugin.shutdown()
+    fake.stop()
+
+    done = [result for result in results if result[0] == "done"]
+    print(f"orders: {args.orders}, buyers: {args.buyers}, ns.gifts latency: {args.latency * 1000:.0f} ms, errors: {args.error_rate:.1%}")
+    print(f"completed: {len(done)}, timed out: {len(results) - len(done)}, elapsed: {elapsed:.2f} s")
+    print(f"throughput: {len(done) / elapsed:.1f} orders/s")
+    print(f"order, end to end      {percentiles([result[1] for result in done])}")
+    print(f"confirm → finished     {percentiles([result[2] for result in done])}")
+    print(f"event handler          {percentiles(events.handle_times)}")
+    print("plugin stages:")
+    report_histograms("steamgifts_stage_seconds", "stage")
+    print("ns.gifts calls:")
+    report_histograms("steamgifts_api_seconds", "call")
+    outcomes = ", ".join(f"{labels['result']}={value:g}" for labels, value in autogiftsteam.metrics.counter_values("steamgifts_orders_total"))
+    print(f"outcomes: {outcomes}")
+    print(f"fake ns.gifts requests: {dict(fake.calls)}, refunds: {len(account.refunds)}")
+    print(f"max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    if peak is not None:
+        print(f"tracemalloc peak: {peak / 1024 / 1024:.1f} MiB")
+
+    problems = check_dispatch(plugin, fake, events, results, args)
+    if args.keep:
+        print(f"plugin data: {storage_dir}")
+    else:
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    if problems:
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        sys.exit(1)
+    print(f"dispatch check: ok, each of {len(fake.orders)} gifts accepted by ns.gifts once")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Бенчмарк рендеринга шаблонов сообщений: str.format на каждый вызов против предкомпилированных
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_templates.py --calls 200000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogiftsteam import DEFAULT_CONFIG, TEMPLATE_FIELDS, ConfigStore  # noqa: E402
+
+CALLS = (
+    ("start_message", {}),
+    ("link_confirmation", {"link": "https://steamcommunity.com/profiles/76561198012345678"}),
+    ("purchase_success", {"game_name": "Dead by Daylight"}),
+    ("purchase_error", {"error": "Insufficient balance"}),
+)
+
+
+def legacy_format(config: dict, defaults: dict, template_name: str, **kwargs) -> str:
+    # Прежний ConfigStore.format_template
+    template = config.get("templates", {}).get(template_name, "")
+    if not template:
+        template = defaults.get("templates", {}).get(template_name, "")
+    try:
+        return template.format(**kwargs)
+    except KeyError:
+        return template
+
+
+def run(label: str, func, calls: int) -> None:
+    started = time.perf_counter()
+    for i in range(calls):
+        name, values = CALLS[i % len(CALLS)]
+        func(name, **values)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {elapsed * 1e9 / calls:8.0f} ns/message")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    store = ConfigStore("bench-config.json", ".", DEFAULT_CONFIG, template_fields=TEMPLATE_FIELDS)
+    store.config = json.loads(json.dumps(DEFAULT_CONFIG))
+    store.compile_templates()
+
+    for name, values in CALLS:
+        assert store.format_template(name, **values) == legacy_format(store.config, DEFAULT_CONFIG, name, **values)
+
+    run("legacy", lambda name, **values: legacy_format(store.config, DEFAULT_CONFIG, name, **values), args.calls)
+    run("compiled", store.format_template, args.calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Проверка single-flight получения токена на локальной заглушке ns.gifts
+
+Много потоков одновременно запрашивают токен:
+- токен истёк — к /get_token уходит ровно один запрос, остальные ждут его результата
+- токен близок к истечению — все получают кэшированный токен сразу, обновление идёт одно и в фоне
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_tokens.py --threads 64 --token-latency 0.2
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from autogiftsteam import HTTPTransport, TokenCache, TokenManager, scheduler  # noqa: E402
+from fakes import FakeNSGifts  # noqa: E402
+
+
+def burst(manager: TokenManager, threads: int) -> tuple[set[str], list[float]]:
+    barrier = threading.Barrier(threads)
+    tokens: set[str] = set()
+    waits: list[float] = []
+    lock = threading.Lock()
+
+    def worker() -> None:
+        barrier.wait()
+        started = time.perf_counter()
+        token = manager.get_token()
+        with lock:
+            tokens.add(token)
+            waits.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return tokens, waits
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--token-latency", type=float, default=0.2, help="задержка ответа /get_token, с")
+    args = parser.parse_args()
+
+    fake = FakeNSGifts(latency=0.0, token_latency=args.token_latency).start()
+    transport = HTTPTransport(base_url=f"{fake.url}/api/v1", pool_size=args.threads, retries=0)
+    manager = TokenManager("bench@example.com", "bench", transport, refresh_margin=300)
+    try:
+        manager.cache = TokenCache("expired-token", time.time() - 1)
+        tokens, waits = burst(manager, args.threads)
+        print(
+            f"expired token:  {args.threads} callers, get_token requests: {fake.calls['get_token']}, "
+            f"max wait {max(waits) * 1000:.1f} ms"
+        )
+        assert fake.calls["get_token"] == 1, f"ожидался один запрос токена, было {fake.calls['get_token']}"
+        assert tokens == {"bench-token"}, f"вызывающие получили разные токены: {tokens}"
+
+        manager.cache = TokenCache("expiring-token", time.time() + 60)
+        tokens, waits = burst(manager, args.threads)
+        deadline = time.monotonic() + 10 * args.token_latency + 5
+        while manager.cache.token != "bench-token" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        print(
+            f"expiring token: {args.threads} callers, get_token requests: {fake.calls['get_token'] - 1}, "
+            f"max wait {max(waits) * 1000:.1f} ms"
+        )
+        assert fake.calls["get_token"] == 2, f"ожидалось одно фоновое обновление, было {fake.calls['get_token'] - 1}"
+        assert tokens == {"expiring-token"}, "вызывающие ждали обновления вместо кэшированного токена"
+        assert max(waits) < args.token_latency, "вызывающие ждали фонового обновления"
+        print("ok")
+    finally:
+        scheduler.stop()
+        transport.close()
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Проверка переиспользования соединений HTTPTransport на локальной заглушке ns.gifts
+
+Последовательные вызовы API должны идти через одно keep-alive соединение, параллельные —
+не больше чем через одно соединение на поток, без нового соединения на каждый вызов.
+Для сравнения те же вызовы выполняются прежним способом, через requests.get на каждый запрос.
+
+Запуск из каталога с плагином (нужны зависимости FunPayCardinal):
+    python benchmarks/bench_transport.py --calls 200 --threads 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from autogiftsteam import HTTPTransport, NSGiftsAPIClient, TokenManager  # noqa: E402
+from fakes import FakeNSGifts  # noqa: E402
+
+
+def make_client(url: str, pool_size: int) -> NSGiftsAPIClient:
+    transport = HTTPTransport(base_url=f"{url}/api/v1", pool_size=pool_size, retries=0)
+    return NSGiftsAPIClient(TokenManager("bench@example.com", "bench", transport))
+
+
+def measure(label: str, fake: FakeNSGifts, func, calls: int, threads: int = 1) -> int:
+    connections = fake.connections
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda _: func(), range(calls)))
+    else:
+        for _ in range(calls):
+            func()
+    elapsed = time.perf_counter() - started
+    opened = fake.connections - connections
+    print(f"{label:<28} {elapsed * 1000 / calls:7.2f} ms/call  connections: {opened}")
+    return opened
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    fake = FakeNSGifts(latency=0.0).start()
+    try:
+        client = make_client(fake.url, args.pool_size)
+        client.get_balance()  # токен и первое соединение
+
+        sequential = measure("transport, sequential", fake, client.get_balance, args.calls)
+        parallel = measure("transport, parallel", fake, client.get_balance, args.calls, args.threads)
+        measure(
+            "requests.get per call",
+            fake,
+            lambda: requests.get(f"{fake.url}/api/v1/check_balance", timeout=10).json(),
+            args.calls,
+        )
+        client.transport.close()
+    finally:
+        fake.stop()
+
+    assert sequential == 0, f"последовательные вызовы открыли {sequential} новых соединений"
+    # Пул не блокирует потоки сверх pool_size: лишние соединения открываются, но не на каждый вызов
+    assert parallel <= args.threads, f"параллельные вызовы открыли {parallel} соединений на {args.threads} потоков"
+    print(f"ok: {args.calls} sequential calls reused one connection, get_token calls: {fake.calls['get_token']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Локальные заглушки FunPay, Telegram и ns.gifts для бенчмарков плагина"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class FakeNSGifts:
+    """HTTP-сервер с API ns.gifts: задержка, разброс и доля ошибок настраиваются"""
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 1,
+        token_latency: float = 0.0,
+    ):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls: dict[str, int] = defaultdict(int)
+        # Принятые create_order по Idempotency-Key: каждый гифт должен дойти до провайдера один раз
+        self.orders: dict[str, int] = defaultdict(int)
+        # Принятые TCP-соединения: по ним видно, переиспользует ли клиент keep-alive
+        self.connections = 0
+        self.client_ports: set[int] = set()
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> FakeNSGifts:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят разными записями: без TCP_NODELAY keep-alive ответы ждут отложенного ACK
+            disable_nagle_algorithm = True
+
+            def setup(self) -> None:
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+                    fake.client_ports.add(self.client_address[1])
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(self, code: int, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                code, payload = fake.handle(
+                    self.path.rsplit("/api/v1/", 1)[-1].lstrip("/"), body, self.headers.get("Idempotency-Key")
+                )
+                self.reply(code, payload)
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-nsgifts", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, endpoint: str, body: dict, key: str | None = None) -> tuple[int, dict]:
+        with self._lock:
+            self.calls[endpoint] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+
+        if endpoint == "get_token":
+            time.sleep(self.token_latency)
+            return 200, {"token": "bench-token", "valid_thru": time.time() + 7200}
+
+        time.sleep(delay)
+        if endpoint == "check_balance":
+            return 200, {"success": True, "balance": 1e9}
+        if failed:
+            return 500, {"success": False, "error": "fake server error"}
+        if endpoint == "steam_gift/create_order":
+            with self._lock:
+                self.orders[key or ""] += 1
+            return 200, {"success": True, "order_id": f"NS{next(self._ids)}", "status": "processing"}
+        if endpoint.endswith("order_status"):
+            return 200, {"orders": [{"order_id": order_id, "status": "completed"} for order_id in body.get("order_ids", [])]}
+        return 404, {"success": False, "error": f"unknown endpoint {endpoint}"}
+
+
+class FakeAccount:
+    """Аккаунт FunPay: заказы генерируются по ID, сообщения складываются по чатам"""
+
+    def __init__(self, lot_id: str, price: float = 100.0):
+        self.id = 1
+        self.lot_id = lot_id
+        self.price = price
+        self.messages: dict[int, list[tuple[float, str]]] = defaultdict(list)
+        self.refunds: list[int] = []
+        self.changed = threading.Condition()
+
+    @staticmethod
+    def chat_of(order_id: int) -> int:
+        return 1_000_000 + order_id
+
+    def get_order(self, order_id: int) -> SimpleNamespace:
+        return SimpleNamespace(
+            id=order_id,
+            chat_id=self.chat_of(order_id),
+            buyer_id=order_id,
+            buyer_username=f"buyer{order_id}",
+            sum=self.price,
+            amount=1,
+            lot_id=self.lot_id,
+            status="paid",
+        )
+
+    def send_message(self, chat_id: int, text: str, *args, **kwargs) -> None:
+        with self.changed:
+            self.messages[chat_id].append((time.perf_counter(), text))
+            self.changed.notify_all()
+
+    def refund(self, order_id: int) -> None:
+        self.refunds.append(order_id)
+
+    def get_user(self, user_id: int) -> SimpleNamespace:
+        return SimpleNamespace(get_lots=lambda: [])
+
+
+class FakeBot:
+    """telebot.TeleBot, который принимает любые вызовы"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            self.calls += 1
+            return SimpleNamespace(id=1, message_id=1, chat=SimpleNamespace(id=1))
+
+        return call
+
+
+class FakeCardinal:
+    def __init__(self, account: FakeAccount) -> None:
+        self.account = account
+        self.telegram = SimpleNamespace(bot=FakeBot(), authorized_users=[1])
+
+    def add_telegram_commands(self, *args, **kwargs) -> None:
+        pass
+
+
+def order_event(order_id: int, lot_id: str) -> SimpleNamespace:
+    # Обработчики читают только event.order / event.message, как у событий FunPayAPI
+    return SimpleNamespace(order=SimpleNamespace(id=order_id, lot_id=lot_id))
+
+
+def message_event(order_id: int, text: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        message=SimpleNamespace(chat_id=FakeAccount.chat_of(order_id), author_id=order_id, content=text)
+    )